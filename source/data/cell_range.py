@@ -0,0 +1,138 @@
+import builtins
+import operator
+
+import numpy as np
+
+'''
+    Ranges (eg A1:B5) are handed to formulas as a CellRange rather than a
+    list. The values are one 2-D block sliced out of the table, so
+    aggregates and arithmetic run as single NumPy operations.
+'''
+
+
+def _as_float(values):
+    if values.dtype.kind in 'fiub':
+        return values
+    try:
+        return values.astype(float)
+    except (TypeError, ValueError):
+        return None
+
+
+def _binary(op, reflected=False):
+    def method(self, other):
+        if isinstance(other, CellRange):
+            other = other.values
+        if reflected:
+            return op(other, self.values)
+        return op(self.values, other)
+    return method
+
+
+class CellRange:
+    '''
+        values - 2-D array of cell values, rows x columns
+
+        Iterating, indexing with an int and len() treat the range as the
+        flat row-major list of cells that formulas used to receive.
+    '''
+
+    __array_priority__ = 10
+
+    def __init__(self, values):
+        self.values = values
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        return self.values.size
+
+    def __iter__(self):
+        return iter(self.values.ravel())
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.values.ravel()[index]
+        return self.values[index]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.values
+        return self.values.astype(dtype)
+
+    def __repr__(self):
+        return 'CellRange({})'.format(self.values.tolist())
+
+    def numeric(self):
+        '''
+            Values as floats with empty cells as NaN, or None if the range
+            holds anything non numeric
+        '''
+        return _as_float(self.values)
+
+    def sum(self, start=0):
+        values = self.numeric()
+        if values is None:
+            return builtins.sum(self, start)
+        return np.nansum(values) + start
+
+    def mean(self):
+        return np.nanmean(self.numeric())
+
+    def min(self):
+        values = self.numeric()
+        if values is None:
+            return builtins.min(self)
+        return np.nanmin(values)
+
+    def max(self):
+        values = self.numeric()
+        if values is None:
+            return builtins.max(self)
+        return np.nanmax(values)
+
+    __add__ = _binary(operator.add)
+    __radd__ = _binary(operator.add, reflected=True)
+    __sub__ = _binary(operator.sub)
+    __rsub__ = _binary(operator.sub, reflected=True)
+    __mul__ = _binary(operator.mul)
+    __rmul__ = _binary(operator.mul, reflected=True)
+    __truediv__ = _binary(operator.truediv)
+    __rtruediv__ = _binary(operator.truediv, reflected=True)
+    __floordiv__ = _binary(operator.floordiv)
+    __rfloordiv__ = _binary(operator.floordiv, reflected=True)
+    __mod__ = _binary(operator.mod)
+    __rmod__ = _binary(operator.mod, reflected=True)
+    __pow__ = _binary(operator.pow)
+    __rpow__ = _binary(operator.pow, reflected=True)
+
+    def __neg__(self):
+        return -self.values
+
+
+def _range_aggregate(name, keywords=()):
+    '''
+        keywords - keyword arguments the CellRange method takes. Anything
+                   else (eg max(A0:A2, default=0)) goes to the builtin with
+                   the range as a list.
+    '''
+    fallback = getattr(builtins, name)
+
+    def aggregate(*args, **kwargs):
+        if len(args) == 1 and isinstance(args[0], CellRange):
+            if all(k in keywords for k in kwargs):
+                return getattr(args[0], name)(**kwargs)
+            return fallback(list(args[0]), **kwargs)
+        return fallback(*args, **kwargs)
+    aggregate.__name__ = name
+    return aggregate
+
+
+# Available to every formula, after any script provided names
+range_functions = {
+        'sum' : _range_aggregate('sum', ('start',)),
+        'min' : _range_aggregate('min'),
+        'max' : _range_aggregate('max'),
+        }
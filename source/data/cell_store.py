@@ -0,0 +1,442 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+import pandas as pd
+
+from .formula import colint, colval
+
+'''
+    Cell storage for TableData
+
+    Each column is split into chunks of CHUNK_SIZE rows. A chunk holds a
+    typed array (int64, float64, or object when anything else is written)
+    and a validity mask, so point reads and writes are O(1) and writing to
+    a new row or column never reallocates the rest of the sheet.
+'''
+
+CHUNK_SIZE = 1024
+
+INT = 'i'
+FLOAT = 'f'
+OBJECT = 'O'
+
+_dtypes = {
+        INT : np.int64,
+        FLOAT : np.float64,
+        OBJECT : object,
+        }
+
+_int64_min = np.iinfo(np.int64).min
+_int64_max = np.iinfo(np.int64).max
+
+
+def is_empty(value):
+    if value is None:
+        return True
+    if isinstance(value, float):
+        return np.isnan(value)
+    return False
+
+
+def value_kind(value):
+    if isinstance(value, (bool, np.bool_)):
+        return OBJECT
+    if isinstance(value, (int, np.integer)):
+        if _int64_min <= value <= _int64_max:
+            return INT
+        return OBJECT
+    if isinstance(value, (float, np.floating)):
+        return FLOAT
+    return OBJECT
+
+
+def array_kind(values):
+    kind = values.dtype.kind
+    if kind in 'iu':
+        return INT
+    if kind == 'f':
+        return FLOAT
+    return OBJECT
+
+
+def wider_kind(a, b):
+    if a == b:
+        return a
+    if OBJECT in (a, b):
+        return OBJECT
+    return FLOAT
+
+
+class Chunk:
+    '''
+        CHUNK_SIZE rows of one column
+
+        values - int64, float64 or object array
+        valid - False where the cell is empty
+    '''
+
+    __slots__ = ('values', 'valid')
+
+    def __init__(self, kind):
+        self.values = np.zeros(CHUNK_SIZE, dtype=_dtypes[kind])
+        if kind == OBJECT:
+            self.values[:] = None
+        self.valid = np.zeros(CHUNK_SIZE, dtype=bool)
+
+    @classmethod
+    def from_arrays(cls, values, valid):
+        '''
+            Wraps existing arrays (eg views of a mapped file) without copying
+        '''
+        chunk = cls.__new__(cls)
+        chunk.values = values
+        chunk.valid = valid
+        return chunk
+
+    @property
+    def kind(self):
+        return array_kind(self.values)
+
+    def widen(self, kind):
+        new_kind = wider_kind(self.kind, kind)
+        if new_kind == self.kind:
+            return
+        values = self.values.astype(_dtypes[new_kind])
+        if new_kind == OBJECT:
+            values[~self.valid] = None
+        self.values = values
+
+    def get(self, offset):
+        if not self.valid[offset]:
+            return None
+        value = self.values[offset]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def set(self, offset, value):
+        if is_empty(value):
+            self.valid[offset] = False
+            if self.kind == OBJECT:
+                self.values[offset] = None
+            return
+        self.widen(value_kind(value))
+        self.values[offset] = value
+        self.valid[offset] = True
+
+    def set_many(self, offsets, values):
+        '''
+            values - array aligned with offsets
+        '''
+        kind = array_kind(values)
+        if kind == OBJECT:
+            if values.dtype.kind in 'mM':
+                # Assigned to an object array as is they'd become raw ints
+                values = pd.Series(values).astype(object).to_numpy()
+            valid = ~pd.isna(values)
+            values = values.copy()
+            values[~valid] = None
+            self.widen(OBJECT)
+            self.values[offsets] = values
+            self.valid[offsets] = valid
+            return
+        valid = np.ones(len(values), dtype=bool)
+        if kind == FLOAT:
+            valid = ~np.isnan(values)
+        self.widen(kind)
+        self.values[offsets] = values
+        self.valid[offsets] = valid
+        if self.kind == OBJECT:
+            self.values[offsets[~valid]] = None
+
+    def is_empty(self):
+        return not self.valid.any()
+
+
+class Column:
+
+    def __init__(self):
+        self.chunks = {}
+
+    def get(self, row):
+        chunk = self.chunks.get(row // CHUNK_SIZE)
+        if chunk is None:
+            return None
+        return chunk.get(row % CHUNK_SIZE)
+
+    def has(self, row):
+        chunk = self.chunks.get(row // CHUNK_SIZE)
+        if chunk is None:
+            return False
+        return bool(chunk.valid[row % CHUNK_SIZE])
+
+    def set(self, row, value):
+        index = row // CHUNK_SIZE
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            if is_empty(value):
+                return
+            chunk = Chunk(value_kind(value))
+            self.chunks[index] = chunk
+        chunk.set(row % CHUNK_SIZE, value)
+
+    def set_many(self, rows, values):
+        rows = np.asarray(rows, dtype=np.int64)
+        values = np.asarray(values)
+        if len(rows) == 0:
+            return
+        indices = rows // CHUNK_SIZE
+        offsets = rows % CHUNK_SIZE
+        kind = array_kind(values)
+        for index in np.unique(indices):
+            mask = indices == index
+            chunk = self.chunks.get(int(index))
+            if chunk is None:
+                chunk = Chunk(kind)
+                self.chunks[int(index)] = chunk
+            chunk.set_many(offsets[mask], values[mask])
+
+    def get_range(self, start, end):
+        '''
+            Values for rows start..end inclusive. Numeric columns come back
+            as float64 with NaN for empty cells, anything else as object
+            with None.
+        '''
+        size = end - start + 1
+        first = start // CHUNK_SIZE
+        last = end // CHUNK_SIZE
+        chunks = [(i, self.chunks[i]) for i in range(first, last + 1) if i in self.chunks]
+        numeric = all(chunk.kind != OBJECT for _, chunk in chunks)
+        if numeric:
+            out = np.full(size, np.nan)
+        else:
+            out = np.full(size, None, dtype=object)
+        for index, chunk in chunks:
+            chunk_start = index * CHUNK_SIZE
+            lo = max(start, chunk_start)
+            hi = min(end, chunk_start + CHUNK_SIZE - 1)
+            src = slice(lo - chunk_start, hi - chunk_start + 1)
+            dst = slice(lo - start, hi - start + 1)
+            valid = chunk.valid[src]
+            out[dst][valid] = chunk.values[src][valid]
+        return out
+
+    def get_int_range(self, start, end):
+        '''
+            Values for rows start..end inclusive as int64, or None unless
+            every one of them holds an int
+        '''
+        out = np.empty(end - start + 1, dtype=np.int64)
+        for index in range(start // CHUNK_SIZE, end // CHUNK_SIZE + 1):
+            chunk = self.chunks.get(index)
+            if chunk is None or chunk.kind != INT:
+                return None
+            chunk_start = index * CHUNK_SIZE
+            lo = max(start, chunk_start)
+            hi = min(end, chunk_start + CHUNK_SIZE - 1)
+            src = slice(lo - chunk_start, hi - chunk_start + 1)
+            if not chunk.valid[src].all():
+                return None
+            out[lo - start:hi - start + 1] = chunk.values[src]
+        return out
+
+    def row_bounds(self):
+        '''
+            (first, last) occupied rows, or None if the column is empty
+        '''
+        first = None
+        last = None
+        for index in sorted(self.chunks):
+            rows = np.flatnonzero(self.chunks[index].valid)
+            if len(rows):
+                if first is None:
+                    first = index * CHUNK_SIZE + int(rows[0])
+                last = index * CHUNK_SIZE + int(rows[-1])
+        if first is None:
+            return None
+        return (first, last)
+
+    def is_empty(self):
+        return all(chunk.is_empty() for chunk in self.chunks.values())
+
+    def _next_chunk(self, index, step):
+        indices = sorted(self.chunks)
+        if step > 0:
+            i = bisect_right(indices, index)
+            return indices[i] if i < len(indices) else None
+        i = bisect_left(indices, index)
+        return indices[i - 1] if i > 0 else None
+
+    def next_change(self, row, step):
+        '''
+            First row after `row`, going in direction step (1 or -1), that
+            is empty when `row` isn't or the other way round. None if there
+            isn't one. Rows before 0 count as empty.
+        '''
+        state = self.has(row)
+        r = row + step
+        while r >= 0:
+            index = r // CHUNK_SIZE
+            chunk = self.chunks.get(index)
+            if chunk is None:
+                if state:
+                    return r
+                index = self._next_chunk(index, step)
+                if index is None:
+                    return None
+                r = index * CHUNK_SIZE if step > 0 else (index + 1) * CHUNK_SIZE - 1
+                continue
+            offset = r % CHUNK_SIZE
+            if step > 0:
+                valid = chunk.valid[offset:]
+            else:
+                valid = chunk.valid[offset::-1]
+            hits = np.flatnonzero(valid != state)
+            if len(hits):
+                return r + step * int(hits[0])
+            r = (index + 1) * CHUNK_SIZE if step > 0 else index * CHUNK_SIZE - 1
+        return -1 if state else None
+
+
+def is_column_name(col):
+    return isinstance(col, str) and col.isalpha() and col.isupper()
+
+
+class CellStore:
+    '''
+        Columns keyed by name (eg "A"), rows by int
+    '''
+
+    def __init__(self):
+        self.columns = {}
+
+    def get(self, row, col):
+        column = self.columns.get(col)
+        if column is None:
+            return None
+        return column.get(row)
+
+    def has(self, row, col):
+        column = self.columns.get(col)
+        if column is None:
+            return False
+        return column.has(row)
+
+    def set(self, row, col, value):
+        column = self.columns.get(col)
+        if column is None:
+            if is_empty(value):
+                return
+            column = Column()
+            self.columns[col] = column
+        column.set(row, value)
+
+    def set_many(self, col, rows, values):
+        '''
+            Writes values to rows of one column in a single step
+        '''
+        if col not in self.columns:
+            self.columns[col] = Column()
+        self.columns[col].set_many(rows, values)
+
+    def get_column(self, col, start, end):
+        column = self.columns.get(col)
+        if column is None:
+            return np.full(end - start + 1, np.nan)
+        return column.get_range(start, end)
+
+    def get_int_column(self, col, start, end):
+        column = self.columns.get(col)
+        if column is None:
+            return None
+        return column.get_int_range(start, end)
+
+    def get_block(self, start, end, cols):
+        '''
+            2-D array, rows start..end inclusive by cols
+        '''
+        columns = [self.get_column(col, start, end) for col in cols]
+        if all(c.dtype.kind == 'f' for c in columns):
+            return np.column_stack(columns) if columns else np.empty((end - start + 1, 0))
+        block = np.empty((end - start + 1, len(columns)), dtype=object)
+        for i, values in enumerate(columns):
+            if values.dtype.kind == 'f':
+                values = values.astype(object)
+                values[pd.isna(values)] = None
+            block[:, i] = values
+        return block
+
+    def ordered_columns(self):
+        '''
+            Every column from A to the last named one, then any others
+        '''
+        named = [col for col in self.columns if is_column_name(col)]
+        others = [col for col in self.columns if not is_column_name(col)]
+        if not named:
+            return others
+        last = max(colint(col) for col in named)
+        return [colval(c) for c in range(last + 1)] + others
+
+    def occupied_columns(self, row):
+        '''
+            Sorted column numbers with a value in row
+        '''
+        return sorted(colint(col) for col, column in self.columns.items()
+                      if is_column_name(col) and column.has(row))
+
+    def next_change_in_column(self, col, row, step):
+        column = self.columns.get(col)
+        if column is None:
+            return None
+        return column.next_change(row, step)
+
+    def next_change_in_row(self, row, c, step):
+        '''
+            Same as Column.next_change, across the columns of one row
+        '''
+        occupied = self.occupied_columns(row)
+        if step > 0:
+            i = bisect_right(occupied, c)
+        else:
+            i = bisect_left(occupied, c) - 1
+        if c not in occupied:
+            return occupied[i] if 0 <= i < len(occupied) else None
+        # Walk to the end of the run c is in
+        nxt = c + step
+        while 0 <= i < len(occupied) and occupied[i] == nxt:
+            i += step
+            nxt += step
+        return nxt
+
+    def column_bounds(self):
+        cols = [colint(col) for col, column in self.columns.items()
+                if is_column_name(col) and not column.is_empty()]
+        if not cols:
+            return None
+        return (min(cols), max(cols))
+
+    def row_bounds(self):
+        bounds = [column.row_bounds() for column in self.columns.values()]
+        bounds = [b for b in bounds if b is not None]
+        if not bounds:
+            return None
+        return (min(b[0] for b in bounds), max(b[1] for b in bounds))
+
+    def to_dataframe(self):
+        bounds = self.row_bounds()
+        if bounds is None:
+            return pd.DataFrame()
+        start = min(0, bounds[0])
+        end = bounds[1]
+        data = {}
+        for col in self.ordered_columns():
+            data[col] = self.get_column(col, start, end)
+        return pd.DataFrame(data, index=range(start, end + 1))
+
+    @classmethod
+    def from_dataframe(cls, frame):
+        store = cls()
+        rows = np.asarray(frame.index, dtype=np.int64)
+        for col in frame.columns:
+            store.set_many(col, rows, frame[col].to_numpy())
+        return store
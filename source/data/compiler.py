@@ -0,0 +1,170 @@
+import ast
+import re
+
+'''
+    Formulas are compiled once per distinct formula text. Every cell token
+    (eg A1, $B$2, $A1:B5) is swapped for a named parameter, the result is
+    parsed with `ast` and compiled to a code object. A root formula and all
+    of its children share the same CompiledFormula since they share text.
+'''
+
+column_re = r'\$?[A-Z]+'
+row_re = r'\$?[0-9]+'
+cell_re = column_re + row_re
+
+# A cell token can't be part of a longer name (LOG10), an attribute (x.A1)
+# or a function call (A1(...)). String literals are matched first so that
+# their contents are left untouched.
+string_re = r'''(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")'''
+bounded_token_re = r'(?<![\w.$])(?P<token>' + cell_re + '(?::' + cell_re + r')?)(?![\w$(])'
+formula_token_re = re.compile(string_re + '|' + bounded_token_re)
+
+PARAM_PREFIX = 'DECEL_VAR_'
+
+# Formulas built only from these can be evaluated over whole columns
+vector_nodes = (
+        ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+        ast.UAdd, ast.USub,
+        )
+
+_compiled_formulae = {}
+
+
+def param_name(index):
+    return '{}{}'.format(PARAM_PREFIX, index)
+
+
+def _substitute(formula, replace):
+    def sub(match):
+        token = match.group('token')
+        if token is None:
+            return match.group(0)
+        return replace(token)
+    return formula_token_re.sub(sub, formula)
+
+
+class CompiledFormula:
+    '''
+        formula - the formula text (eg 5 * A1 + sum($B$1:B4))
+
+        tokens - distinct cell tokens, in order of first appearance
+        params - token -> parameter name used in the compiled code
+        names - free names used by the formula (functions, script vars)
+        code - compiled code object, or None if the formula is invalid
+        vectorizable - arithmetic on single cells only, so the code gives
+                       the same result when fed NumPy columns
+    '''
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.tokens = []
+        self.params = {}
+        self.names = frozenset()
+        self.code = None
+        self.error = None
+        self.vectorizable = False
+        self._call_arguments = {}
+        self._compile()
+
+    def _param_for(self, token):
+        if token not in self.params:
+            self.tokens.append(token)
+            self.params[token] = param_name(len(self.tokens))
+        return self.params[token]
+
+    def _compile(self):
+        self.source = _substitute(self.formula, self._param_for)
+        try:
+            tree = ast.parse(self.source.strip(), mode='eval')
+        except SyntaxError as e:
+            self.error = e
+            return
+        params = set(self.params.values())
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id not in params:
+                names.add(node.id)
+        self.names = frozenset(names)
+        self.code = compile(tree, '<formula: {}>'.format(self.formula), 'eval')
+        self.vectorizable = self._is_vectorizable(tree)
+
+    def _is_vectorizable(self, tree):
+        if self.names or any(':' in t for t in self.tokens):
+            return False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant):
+                if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                    return False
+            elif not isinstance(node, vector_nodes):
+                return False
+        return True
+
+    def is_valid(self):
+        return self.code is not None
+
+    def evaluate(self, values, namespace, code=None):
+        '''
+            values - token -> value
+            namespace - mapping of names available to the formula
+            code - evaluated instead of the whole formula, eg from
+                   call_arguments
+        '''
+        local_vars = {}
+        for token, value in values.items():
+            local_vars[self.params[token]] = value
+        if code is None:
+            code = self.code
+        return eval(code, {}, _Scope(local_vars, namespace))
+
+    def call_arguments(self, name):
+        '''
+            Code giving (args, kwargs) for each call to `name` in the
+            formula, so the arguments can be found without running the rest
+            of it. Calls using *args or **kwargs are left out.
+        '''
+        codes = self._call_arguments.get(name)
+        if codes is not None:
+            return codes
+        codes = []
+        if self.is_valid():
+            tree = ast.parse(self.source.strip(), mode='eval')
+            for node in ast.walk(tree):
+                if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == name):
+                    continue
+                if any(isinstance(a, ast.Starred) for a in node.args) or any(k.arg is None for k in node.keywords):
+                    continue
+                args = ast.Tuple(node.args, ast.Load())
+                kwargs = ast.Dict([ast.Constant(k.arg) for k in node.keywords], [k.value for k in node.keywords])
+                expression = ast.fix_missing_locations(ast.Expression(ast.Tuple([args, kwargs], ast.Load())))
+                codes.append(compile(expression, '<arguments: {}>'.format(self.formula), 'eval'))
+        self._call_arguments[name] = codes
+        return codes
+
+    def render(self, replacements):
+        '''
+            Rebuild the formula text with tokens replaced, eg for children
+        '''
+        return _substitute(self.formula, lambda t: replacements.get(t, t))
+
+
+class _Scope(dict):
+    '''
+        Parameters first, then the shared namespace. Avoids copying the
+        namespace for every evaluation.
+    '''
+
+    def __init__(self, params, namespace):
+        super().__init__(params)
+        self.namespace = namespace
+
+    def __missing__(self, key):
+        return self.namespace[key]
+
+
+def compile_formula(formula):
+    compiled = _compiled_formulae.get(formula)
+    if compiled is None:
+        compiled = CompiledFormula(formula)
+        _compiled_formulae[formula] = compiled
+    return compiled
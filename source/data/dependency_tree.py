@@ -1,71 +1,289 @@
+from bisect import bisect_left, bisect_right
 
-class DependencyNode:
+import numpy as np
 
-    def __init__(self, value):
-        self.value = value
-        self.children = []
-        self.parents = []
+from .range_index import RangeIndex
 
-    def add_parent(self, parent):
-        self.parents.append(parent)
 
-    def add_child(self, child):
-        self.children.append(child)
+class _Block:
+    '''
+        Rows start..end of one column written in one go. Planned as a single
+        node whose dependents are found by interval, so a changed column
+        costs the same as a changed cell.
+    '''
 
-    def yield_values(self, seen=None):
-        if seen is None:
-            seen = []
+    __slots__ = ('col', 'start', 'end')
 
-        for parent in self.parents:
-            if parent.value not in seen:
-                for v in parent.yield_values(seen=seen):
-                    yield v
+    def __init__(self, col, start, end):
+        self.col = col
+        self.start = start
+        self.end = end
 
-        yield self.value
-        seen.append(self.value)
 
-        for child in self.children:
-            if child.value not in seen:
-                for v in child.yield_values(seen=seen):
-                    yield v
+class DependencyGraph:
+    '''
+        Links between cells, kept for the life of the table
 
-    def __eq__(self, other):
-        return self.value == other.value
-
-class DependencyTree:
+        precedents - formula cell -> set of single cells it reads
+        dependents - cell -> set of formula cells that read it directly
+        ranges - formula cell -> set of rectangles it reads
+        range_index - rectangles, searchable by the cells they cover
+        regions - col -> ([first rows], [regions]) sorted by first row.
+                  A region (eg FillRegion) is a run of formula cells kept
+                  as one node. Its cells aren't in precedents, the
+                  rectangles from its reads() are in range_index instead.
+        dirty - cells and row blocks changed since the last recalculation
+    '''
 
     def __init__(self):
-        self.node_dict = {}
-
-    def shake(self):
-        self.node_dict = {}
-
-    def get_node(self, value):
-        if value in self.node_dict:
-            return self.node_dict[value]
-        out = DependencyNode(value)
-        self.node_dict[value] = out
-        return out
-
-    def add_dependency(self, parent, child):
-        p = self.get_node(parent)
-        c = self.get_node(child)
-        if p not in c.parents:
-            c.add_parent(p)
-        if c not in c.children:
-            p.add_child(c)
-
-    def get_roots(self):
-        roots = []
-        for val in self.node_dict:
-            node = self.node_dict[val]
-            if len(node.parents) == 0:
-                roots.append(node)
-        return roots
-
-    def yield_values(self):
-        seen = []
-        for r in self.get_roots():
-            for v in r.yield_values(seen):
-                yield v
+        self.precedents = {}
+        self.dependents = {}
+        self.ranges = {}
+        self.range_index = RangeIndex()
+        self.regions = {}
+        self.dirty = set()
+
+    def set_precedents(self, cell, precedents, ranges=()):
+        '''
+            precedents - single cells (row, col)
+            ranges - rectangles ((row1, row2), (col1, col2))
+        '''
+        if cell in self.precedents:
+            self.remove(cell)
+        precedents = set(precedents)
+        self.precedents[cell] = precedents
+        dependents = self.dependents
+        for p in precedents:
+            if p in dependents:
+                dependents[p].add(cell)
+            else:
+                dependents[p] = {cell}
+        ranges = set(ranges)
+        if ranges:
+            self.ranges[cell] = ranges
+            for rect in ranges:
+                self.range_index.add(rect, cell)
+
+    def remove(self, cell):
+        for p in self.precedents.pop(cell, ()):
+            dependents = self.dependents.get(p)
+            if dependents is not None:
+                dependents.discard(cell)
+                if not dependents:
+                    del self.dependents[p]
+        for rect in self.ranges.pop(cell, ()):
+            self.range_index.remove(rect, cell)
+
+    def add_region(self, region):
+        starts, regions = self.regions.setdefault(region.col, ([], []))
+        i = bisect_left(starts, region.start)
+        starts.insert(i, region.start)
+        regions.insert(i, region)
+        for rect in region.reads():
+            self.range_index.add(rect, region)
+
+    def remove_region(self, region):
+        starts, regions = self.regions[region.col]
+        i = regions.index(region)
+        del starts[i]
+        del regions[i]
+        if not regions:
+            del self.regions[region.col]
+        for rect in region.reads():
+            self.range_index.remove(rect, region)
+
+    def dissolve(self, region):
+        '''
+            Replaces region with one node per cell
+        '''
+        self.remove_region(region)
+        for cell in region.cells:
+            self.set_precedents(cell, *region.references(cell))
+
+    def region_at(self, cell):
+        row, col = cell
+        entry = self.regions.get(col)
+        if entry is None:
+            return None
+        starts, regions = entry
+        i = bisect_right(starts, row) - 1
+        if i >= 0 and row <= regions[i].end:
+            return regions[i]
+        return None
+
+    def regions_in(self, col, start, end):
+        entry = self.regions.get(col)
+        if entry is None:
+            return []
+        starts, regions = entry
+        i = max(bisect_right(starts, start) - 1, 0)
+        j = bisect_right(starts, end)
+        return [region for region in regions[i:j] if region.end >= start]
+
+    def get_dependents(self, cell):
+        direct = self.dependents.get(cell, ())
+        through_range = set(self.range_index.stab(cell))
+        if not through_range:
+            return direct
+        through_range.update(direct)
+        return through_range
+
+    def interval_dependents(self, col, start, end):
+        '''
+            Nodes reading any of rows start..end of col
+        '''
+        nodes = set(self.range_index.overlap(col, start, end))
+        dependents = self.dependents
+        if end - start < len(dependents):
+            for row in range(start, end + 1):
+                found = dependents.get((row, col))
+                if found:
+                    nodes.update(found)
+        else:
+            for (row, c), found in dependents.items():
+                if c == col and start <= row <= end:
+                    nodes.update(found)
+        return nodes
+
+    def formulas_in(self, col, start, end):
+        '''
+            Formula nodes (cells and regions) within rows start..end of col
+        '''
+        nodes = set(self.regions_in(col, start, end))
+        precedents = self.precedents
+        if end - start < len(precedents):
+            nodes.update(cell for cell in ((row, col) for row in range(start, end + 1))
+                         if cell in precedents)
+        else:
+            nodes.update(cell for cell in precedents
+                         if cell[1] == col and start <= cell[0] <= end)
+        return nodes
+
+    def _dependents_of(self, node):
+        if isinstance(node, tuple):
+            return self.get_dependents(node)
+        if isinstance(node, _Block):
+            # Writing over a formula cell recalculates it, as for a cell
+            return self.interval_dependents(node.col, node.start, node.end) | \
+                self.formulas_in(node.col, node.start, node.end)
+        found = self.interval_dependents(node.col, node.start, node.end)
+        found.discard(node)
+        return found
+
+    def mark_dirty(self, cell):
+        self.dirty.add(cell)
+
+    def mark_dirty_rows(self, col, rows):
+        '''
+            Same as marking every (row, col) dirty, with each run of rows
+            kept as one block
+        '''
+        if isinstance(rows, range) and rows.step == 1:
+            if len(rows):
+                self.dirty.add(_Block(col, rows.start, rows.stop - 1))
+            return
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if not len(rows):
+            return
+        breaks = np.flatnonzero(np.diff(rows) != 1)
+        starts = np.concatenate(([rows[0]], rows[breaks + 1]))
+        ends = np.concatenate((rows[breaks], [rows[-1]]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.dirty.add(_Block(col, start, end))
+
+    def has_dirty(self):
+        return len(self.dirty) > 0
+
+    def affected_cells(self, cells):
+        '''
+            Every node reachable from `cells`, mapped to its dependents
+        '''
+        children = {}
+        stack = list(cells)
+        for cell in stack:
+            children[cell] = None
+        while stack:
+            cell = stack.pop()
+            children[cell] = self._dependents_of(cell)
+            for child in children[cell]:
+                if child not in children:
+                    children[child] = None
+                    stack.append(child)
+        return children
+
+    def recalculation_order(self):
+        '''
+            Kahn's algorithm over the nodes affected by the dirty set. Every
+            cell or region is returned exactly once, after all of its
+            precedents. Cells on a cycle can't be ordered and come last.
+        '''
+        _, order, _ = self._plan()
+        return [node for node in order if not isinstance(node, _Block)]
+
+    def recalculate(self, evaluate, prepare=None):
+        '''
+            Evaluates the affected nodes in recalculation order, with early
+            cutoff: a node is only evaluated if it was marked dirty or one
+            of its precedents changed value in this pass.
+
+            evaluate - cell or region -> True if its value changed
+            prepare - optional, called with the affected nodes before any
+                      of them is evaluated
+        '''
+        dirty, order, children = self._plan(prepare)
+        stale = set(dirty)
+        for node in order:
+            if node not in stale:
+                continue
+            if isinstance(node, _Block):
+                stale.update(children[node])
+                continue
+            changed = evaluate(node)
+            if changed or node in dirty:
+                stale.update(children[node])
+
+    def _plan(self, prepare=None):
+        dirty = set()
+        for node in self.dirty:
+            if isinstance(node, tuple):
+                node = self.region_at(node) or node
+            dirty.add(node)
+        self.dirty = set()
+        while True:
+            affected = self.affected_cells(dirty)
+            order, cyclic = self._order(affected)
+            # A region can be on a cycle its cells aren't on, eg a cell
+            # below it reading one of its first rows. Those are taken apart
+            # and ordered cell by cell.
+            regions = [node for node in cyclic if hasattr(node, 'cells')]
+            if not regions:
+                break
+            for region in regions:
+                self.dissolve(region)
+                dirty.discard(region)
+                dirty.update(region.cells)
+        if prepare is not None:
+            prepare(affected)
+        return dirty, order, affected
+
+    def _order(self, children):
+        '''
+            Returns (order, nodes left on or after a cycle)
+        '''
+        indegree = dict.fromkeys(children, 0)
+        for dependents in children.values():
+            for child in dependents:
+                indegree[child] += 1
+
+        order = [node for node, degree in indegree.items() if degree == 0]
+        for node in order:
+            for child in children[node]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    order.append(child)
 
+        cyclic = []
+        if len(order) < len(indegree):
+            cyclic = [node for node, degree in indegree.items() if degree > 0]
+            order.extend(cyclic)
+        return order, cyclic
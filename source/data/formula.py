@@ -1,6 +1,8 @@
 import re
 
-from .script_loader import get_loader
+import numpy as np
+
+from .compiler import compile_formula
 
 class FormulaDecipherException(Exception):
 
@@ -32,6 +34,7 @@ def colint(col_text):
     for power in range(length):
         digit = col_text[length-power-1]
         value += letter_val(digit) * pow(26, power)
+    column_values[col_text] = value - 1
     return value - 1
 
 def ocolval(val):
@@ -68,12 +71,16 @@ class Formula:
         position - [row, col] of formula (eg [1, "AB"])
         formula - the formula (eg $A:B23:$100)
     '''
+
+    __slots__ = ('position', 'table', 'formula', 'formula_dict', 'range_dict', 'compiled')
+
     def __init__(self, cell, formula, table):
         self.position = cell
         self.table = table
         self.formula = formula
         self.formula_dict = {}
         self.range_dict = {}
+        self.compiled = None
         self._decipher()
 
     def root(self):
@@ -85,8 +92,29 @@ class Formula:
     def _origin_col(self):
         return self.position[1]
 
-    def get_value(self):
-        return self.get_value_for_cell((self._origin_row(), self._origin_col()))
+    def get_value(self, namespace=None):
+        return self.get_value_for_cell((self._origin_row(), self._origin_col()), namespace)
+
+    def call_arguments(self, name, namespace=None):
+        '''
+            [(args, kwargs)] this cell would call `name` with, leaving out
+            calls whose arguments can't be evaluated
+        '''
+        root = self.root()
+        compiled = root.compiled
+        codes = compiled.call_arguments(name)
+        if not codes:
+            return []
+        if namespace is None:
+            namespace = root.table.formula_namespace()
+        tokens = root._get_dependent_tokens(self.position)
+        calls = []
+        for code in codes:
+            try:
+                calls.append(compiled.evaluate(tokens, namespace, code))
+            except Exception:
+                pass
+        return calls
 
     def get_dependent_tokens(self):
         tokens = self._get_dependent_tokens(self.position)
@@ -108,8 +136,8 @@ class Formula:
         return self.formula
 
     def _decipher(self):
-        tokens = re.findall(token_re, self.formula)
-        self._load_dict(tokens)
+        self.compiled = compile_formula(self.formula)
+        self._load_dict(self.compiled.tokens)
 
     def _get_cell(self, token):
         col_lock = False
@@ -124,6 +152,7 @@ class Formula:
         if '$' in token:
             row_lock = True
             col, row = token.split('$')
+            row = int(row)
 
         if col is None: # not split
             col_re = r'[A-Z]+'
@@ -131,7 +160,7 @@ class Formula:
             row = int(token[len(col):])
 
         if col is None or row is None:
-            raise FormulaDecipherToken(token)
+            raise FormulaDecipherException(token)
 
         get_row = None
         get_col = None
@@ -139,19 +168,19 @@ class Formula:
         ls = (row_lock, col_lock)
         p = (row, col)
 
+        # Offsets from the root's position, which never moves
         if row_lock:
             get_row = lambda r_in: row
         else:
-            def calc_row(r_in):
-                diff = row - self._origin_row()
-                out = r_in + (row - self._origin_row())
-                return out
-            get_row = calc_row
+            row_offset = row - self._origin_row()
+            get_row = lambda r_in: r_in + row_offset
 
         if col_lock:
-            get_col = lambda c_in: colint(col)
+            locked_col = colint(col)
+            get_col = lambda c_in: locked_col
         else:
-            get_col = lambda c_in: colint(c_in) + (colint(col) - colint(self._origin_col()))
+            col_offset = colint(col) - colint(self._origin_col())
+            get_col = lambda c_in: colint(c_in) + col_offset
 
         # Remove 1 because display is 1 index but data is 0
         return lambda R, C: (get_row(R), get_col(C))
@@ -177,30 +206,35 @@ class Formula:
         self.formula_dict = f_dict
         self.range_dict = range_dict
 
-    def get_dependent_coordinates(self, cell):
-        row, col = cell
-        tokens_to_replace = sorted(self.formula_dict.keys(), key=len, reverse=True)
+    def get_dependent_references(self, cell):
+        '''
+            Cells and ranges read by the formula at cell
+
+            Returns ([(row, col), ...], [((row1, row2), (col1, col2)), ...])
+            with ranges left unexpanded and their columns as ints
+        '''
         cells = []
-        for token in tokens_to_replace:
+        ranges = []
+        for token in self.compiled.tokens:
             a, b = self.formula_dict[token](*cell)
             if self.range_dict.get(token, False):
-                cells.extend(self.table.get_cell_range_coords(a, b))
+                (r1, c1), (r2, c2) = a, b
+                ranges.append(((min(r1, r2), max(r1, r2)), (min(c1, c2), max(c1, c2))))
             else:
                 cells.append((a, colval(b)))
-        return cells
+        return cells, ranges
 
     def _get_dependent_tokens(self, cell):
-        row, col = cell
-        tokens_to_replace = sorted(self.formula_dict.keys(), key=len, reverse=True)
+        formula_dict = self.formula_dict
+        range_dict = self.range_dict
+        table = self.table
         tokens = {}
-        for token in tokens_to_replace:
-            a, b = self.formula_dict[token](*cell)
-
-            if self.range_dict.get(token, False):
-                tokens[token] = self.table.get_cell_range(a, b)
+        for token in self.compiled.tokens:
+            a, b = formula_dict[token](*cell)
+            if range_dict.get(token, False):
+                tokens[token] = table.get_cell_range(a, b)
             else:
-                t_col = colval(b)
-                tokens[token] = self.table.get_cell_value(t_col, a)
+                tokens[token] = table.get_cell_value(colval(b), a)
         return tokens
 
     def iterate_range(self, cellA, cellB):
@@ -219,24 +253,21 @@ class Formula:
                 output.append((r, col))
         return output
 
-    def get_value_for_cell(self, cell):
-        row, col = cell
+    def get_value_for_cell(self, cell, namespace=None):
+        '''
+            namespace - names available to the formula, defaults to
+                        TableData.formula_namespace
+        '''
+        compiled = self.compiled
+        if not compiled.is_valid():
+            return "Formula Error: ({})".format(self.formula)
         tokens = self._get_dependent_tokens(cell)
-
-        token_index = 0
-        local_vars = get_loader().get_vars()
-        tmp_formula = self.formula
-        for token in tokens:
-            token_index += 1
-            varname = "DECEL_VAR_" + colval(token_index)
-            local_vars[varname] = tokens[token]
-            tmp_formula = tmp_formula.replace(token, varname)
         try:
-            val = eval(tmp_formula, {}, local_vars)
-            return val
+            if namespace is None:
+                namespace = self.table.formula_namespace()
+            return compiled.evaluate(tokens, namespace)
         except:
-            val = "Formula Error: ({})".format(tmp_formula)
-            return val
+            return "Formula Error: ({})".format(self.formula)
 
 def adjust_single_token(token, cell):
     c_row, c_col = cell
@@ -265,36 +296,162 @@ def adjust_token(token, formula, cell_s):
         return adjust_single_token(token, cell_s)
 
 class ChildFormula(Formula):
+    '''
+        A copy of a root formula at another position (eg from grab or paste)
+
+        Only the root and position are stored. Parsing, the token dict and
+        the compiled code all live on the root and are shared by every child.
+    '''
+
+    __slots__ = ('parent',)
 
     def __init__(self, parent, cell):
-        super().__init__(cell, parent.formula, parent.table)
+        self.parent = parent.root()
         self.position = cell
-        self.parent = parent
-        self.display_formula = None
+
+    @property
+    def table(self):
+        return self.parent.table
+
+    @property
+    def formula(self):
+        return self.parent.formula
+
+    @property
+    def compiled(self):
+        return self.parent.compiled
+
+    @property
+    def formula_dict(self):
+        return self.parent.formula_dict
+
+    @property
+    def range_dict(self):
+        return self.parent.range_dict
 
     def get_display_formula(self):
-        formula = self.parent.formula
-        if not self.display_formula:
-            tokens_to_replace = sorted(self.parent.formula_dict.keys(), key=len, reverse=True)
-            tokens = {}
-            for token in tokens_to_replace:
-                a, b = self.root().formula_dict[token](*self.position)
-                new_token = adjust_token(token, formula, (a, b))
-                tokens[token] = new_token
-            for token in tokens:
-                formula = formula.replace(token, tokens[token])
-            self.display_formula = formula
-        return self.display_formula
+        root = self.parent
+        tokens = {}
+        for token in root.compiled.tokens:
+            a, b = root.formula_dict[token](*self.position)
+            tokens[token] = adjust_token(token, root.formula, (a, b))
+        return root.compiled.render(tokens)
 
     def root(self):
-        return self.parent.root()
+        return self.parent
 
-    def get_value_for_cell(self, cell):
-        return self.parent.get_value_for_cell(cell)
+    def get_value_for_cell(self, cell, namespace=None):
+        return self.parent.get_value_for_cell(cell, namespace)
 
-    def get_dependent_coordinates(self, cell):
-        coords = self.parent.get_dependent_coordinates(cell)
-        return coords
+class FillRegion:
+    '''
+        A run of cells down one column that share a root formula, eg the
+        result of grabbing a formula downwards. Evaluated in one go by
+        feeding the compiled formula whole columns instead of single cells.
+    '''
+
+    __slots__ = ('root', 'col', 'start', 'end')
+
+    def __init__(self, root, col, start, end):
+        self.root = root
+        self.col = col
+        self.start = start
+        self.end = end
+
+    def rows(self):
+        return range(self.start, self.end + 1)
+
+    @property
+    def cells(self):
+        return [(r, self.col) for r in self.rows()]
+
+    def reads(self):
+        '''
+            Rectangles ((row1, row2), (col1, col2)) read by the region, one
+            per token, with columns as ints
+        '''
+        root = self.root
+        rects = []
+        for token in root.compiled.tokens:
+            first_row, c = root.formula_dict[token](self.start, self.col)
+            last_row, _ = root.formula_dict[token](self.end, self.col)
+            rects.append(((min(first_row, last_row), max(first_row, last_row)), (c, c)))
+        return rects
+
+    def reads_itself(self):
+        '''
+            True if a row of the region reads another row of it, which
+            can only be worked out cell by cell
+        '''
+        col = colint(self.col)
+        for (r1, r2), (c1, _) in self.reads():
+            if c1 == col and r1 <= self.end and self.start <= r2:
+                return True
+        return False
+
+    def references(self, cell):
+        return self.root.get_dependent_references(cell)
+
+    def get_values(self):
+        '''
+            Array of values for every row, or None if the region has to be
+            evaluated cell by cell
+        '''
+        root = self.root
+        compiled = root.compiled
+        if not compiled.vectorizable:
+            return None
+        table = root.table
+        values = {}
+        int_values = {}
+        for token in compiled.tokens:
+            first_row, c = root.formula_dict[token](self.start, self.col)
+            last_row, _ = root.formula_dict[token](self.end, self.col)
+            if first_row == last_row:
+                values[token] = table.get_cell_value(colval(c), first_row)
+                if int_values is not None:
+                    int_values[token] = values[token]
+            else:
+                column = table.get_cell_range((first_row, c), (last_row, c)).numeric()
+                if column is None:
+                    return None
+                values[token] = column.ravel().astype(float)
+                if int_values is not None:
+                    int_values[token] = table.store.get_int_column(colval(c), first_row, last_row)
+                    if int_values[token] is None:
+                        int_values = None
+        result = self._evaluate(compiled, values)
+        if result is None:
+            return None
+        if int_values is not None and result.dtype.kind == 'f':
+            # Int columns give ints cell by cell, so they should here too.
+            # int64 wraps around where Python ints don't, so the result is
+            # only used if it agrees with the float one.
+            int_result = self._evaluate(compiled, int_values)
+            if int_result is None:
+                # eg 2**A0 with a negative A0, which raises cell by cell too
+                return None
+            if int_result.dtype.kind == 'f':
+                return result
+            if not np.allclose(int_result, result, rtol=1e-9, atol=0):
+                return None
+            return int_result
+        return result
+
+    def _evaluate(self, compiled, values):
+        with np.errstate(all='ignore'):
+            try:
+                result = np.asarray(compiled.evaluate(values, {}))
+            except:
+                return None
+        size = self.end - self.start + 1
+        if result.dtype.kind not in 'fiu':
+            return None
+        result = np.broadcast_to(result, (size,))
+        # Errors (eg division by zero) are left to the per cell path
+        if result.dtype.kind == 'f' and not np.isfinite(result).all():
+            return None
+        return result
 
 
 colval(26)
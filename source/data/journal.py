@@ -0,0 +1,236 @@
+import base64
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+'''
+    Change journal kept next to a saved file (<file>.journal)
+
+    Edits are appended as one JSON list per line and the file is only
+    rewritten by an explicit save, which also removes the journal. Opening
+    the file replays the journal on top of it. The journal is created by
+    the first edit, and its first record stamps the file it applies to, so
+    a journal left behind by an older copy of the file is ignored.
+
+        ["base", mtime_ns, size]        file the journal applies to
+        ["v", "A1", value]              value written to a cell, see
+                                        encode_value
+        ["f", "B2", formula]            formula added
+        ["c", "B3", "B2", formula]      child of the formula rooted at B2
+        ["x", "B2"]                     formula removed
+        ["fill", "B2", "B3:C100"]       B2 copied to every cell of B3:C100
+        ["col", "B", runs, dtype, data] values written to a block of one
+                                        column, see encode_column
+'''
+
+BASE = 'base'
+VALUE = 'v'
+FORMULA = 'f'
+CHILD = 'c'
+REMOVE = 'x'
+FILL = 'fill'
+COLUMN = 'col'
+
+# Appended records are written and synced to disk once this many are
+# waiting, or whenever sync() is called
+SYNC_RECORDS = 1000
+
+# Column records of naive datetime objects, kept as microseconds
+DATETIMES = 'datetime'
+_datetime_dtype = np.dtype('<M8[us]')
+
+
+def journal_path(filepath):
+    return filepath + '.journal'
+
+
+def file_stamp(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _row_runs(rows):
+    '''
+        [[first, last], ...] for each run of consecutive rows
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1)
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [len(rows) - 1]))
+    return [[int(rows[a]), int(rows[b])] for a, b in zip(starts, ends)]
+
+
+def _rows_from_runs(runs):
+    if not runs:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(a, b + 1, dtype=np.int64) for a, b in runs])
+
+
+def encode_value(value):
+    '''
+        JSON for one cell value, see decode_value
+    '''
+    if value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, pd.Timestamp):
+        return {'timestamp' : value.isoformat()}
+    if isinstance(value, datetime.datetime):
+        return {'datetime' : value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date' : value.isoformat()}
+    return str(value)
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if 'timestamp' in value:
+            return pd.Timestamp(value['timestamp'])
+        if 'datetime' in value:
+            return datetime.datetime.fromisoformat(value['datetime'])
+        if 'date' in value:
+            return datetime.date.fromisoformat(value['date'])
+    return value
+
+
+def encode_column(rows, values):
+    '''
+        (runs, dtype, data) for values written to rows. Arrays with a fixed
+        size dtype are kept as their raw bytes in base64, anything else as
+        a JSON list, so the values come back with the same types.
+    '''
+    values = np.asarray(values)
+    runs = _row_runs(rows)
+    if values.dtype.kind in 'biufmM':
+        return runs, values.dtype.newbyteorder('<').str, _encode_bytes(values)
+    if len(values) and all(type(v) is datetime.datetime and v.tzinfo is None for v in values):
+        # eg a DatetimeIndex placed by place_dataframe
+        try:
+            stamps = pd.to_datetime(values).to_numpy().astype(_datetime_dtype)
+        except pd.errors.OutOfBoundsDatetime:
+            stamps = values.astype(_datetime_dtype)
+        return runs, DATETIMES, _encode_bytes(stamps)
+    return runs, 'O', [encode_value(v) for v in values]
+
+
+def _encode_bytes(values):
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    return base64.b64encode(np.ascontiguousarray(values).tobytes()).decode('ascii')
+
+
+def decode_column(runs, dtype, data):
+    '''
+        (rows, values) from encode_column
+    '''
+    rows = _rows_from_runs(runs)
+    if dtype == 'O':
+        values = np.empty(len(data), dtype=object)
+        values[:] = [decode_value(v) for v in data]
+        return rows, values
+    if dtype == DATETIMES:
+        return rows, np.frombuffer(base64.b64decode(data), dtype=_datetime_dtype).astype(object)
+    return rows, np.frombuffer(base64.b64decode(data), dtype=np.dtype(dtype)).copy()
+
+
+def _read_records(path):
+    '''
+        Returns (records, length of the file holding whole records). A
+        record cut off by a crash ends the journal.
+    '''
+    records = []
+    length = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            length += len(line)
+    return records, length
+
+
+class Journal:
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.path = journal_path(filepath)
+        self.pending = []
+        self.file = None
+        self.valid = False
+
+    def read(self):
+        '''
+            Records to replay on top of the file, oldest first
+        '''
+        self.valid = False
+        if not os.path.exists(self.path) or not os.path.exists(self.filepath):
+            return []
+        records, length = _read_records(self.path)
+        if not records or records[0] != [BASE] + file_stamp(self.filepath):
+            return []
+        self.valid = True
+        if length != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(length)
+        return records[1:]
+
+    def _open_file(self):
+        if self.valid:
+            self.file = open(self.path, 'a')
+            return
+        self.file = open(self.path, 'w')
+        self.file.write(json.dumps([BASE] + file_stamp(self.filepath)) + '\n')
+        self.valid = True
+
+    def start(self):
+        '''
+            Forgets older edits, called once the file itself is up to date
+        '''
+        self.pending = []
+        self.close()
+        self.valid = False
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def append(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= SYNC_RECORDS:
+            self.sync()
+
+    def sync(self):
+        '''
+            The journal file is created (or reopened, if read() found a
+            valid one) the first time there is something to write
+        '''
+        if not self.pending:
+            return
+        if self.file is None:
+            self._open_file()
+        self.file.write(''.join(json.dumps(r) + '\n' for r in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        self.pending = []
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
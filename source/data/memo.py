@@ -0,0 +1,151 @@
+import hashlib
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from functools import update_wrapper
+
+import numpy as np
+import pandas as pd
+
+from .cell_range import CellRange
+
+'''
+    Result caching for script functions
+
+    Functions decorated with cache() (or pure, which is cache() with the
+    defaults) return the saved result when called again with equal
+    arguments. Arrays, ranges and pandas objects are compared by content,
+    so a helper fed a range that hasn't changed returns straight away.
+    Results are shared between calls, so they shouldn't be modified.
+'''
+
+DEFAULT_MAXSIZE = 1024
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'uncached', 'maxsize', 'currsize'])
+
+_caches = weakref.WeakSet()
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _key_part(value):
+    '''
+        Hashable stand in for value. Raises TypeError if there isn't one.
+    '''
+    if isinstance(value, CellRange):
+        value = value.values
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'O':
+            return ('array', value.shape, tuple(_key_part(v) for v in value.ravel()))
+        return ('array', value.dtype.str, value.shape, _digest(np.ascontiguousarray(value).data))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        hashed = pd.util.hash_pandas_object(value).to_numpy()
+        columns = tuple(value.columns) if isinstance(value, pd.DataFrame) else value.name
+        return (type(value).__name__, columns, _digest(hashed.data))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_key_part(v) for v in value))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((k, _key_part(v)) for k, v in value.items())))
+    hash(value)
+    return value
+
+
+def make_key(args, kwargs):
+    key = tuple(_key_part(a) for a in args)
+    if kwargs:
+        key += (('kwargs',),) + tuple(sorted((k, _key_part(v)) for k, v in kwargs.items()))
+    return key
+
+
+class _Cache:
+    '''
+        LRU of results, each kept for at most ttl seconds (forever if None)
+    '''
+
+    def __init__(self, func, maxsize, ttl):
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = make_key(args, kwargs)
+        except TypeError:
+            # Arguments that can't be compared, always run the function
+            self.uncached += 1
+            return self.func(*args, **kwargs)
+
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or now < expires:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        self.misses += 1
+        value = self.func(*args, **kwargs)
+        expires = None if self.ttl is None else now + self.ttl
+        self.entries[key] = (expires, value)
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.uncached, self.maxsize, len(self.entries))
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+
+def cache(maxsize=DEFAULT_MAXSIZE, ttl=None):
+    '''
+        maxsize - results kept, least recently used go first (None for
+                  no limit)
+        ttl - seconds a result stays valid (None for no limit)
+
+        The decorated function has cache_info() and cache_clear()
+    '''
+    def decorator(func):
+        memo = _Cache(func, maxsize, ttl)
+
+        def wrapper(*args, **kwargs):
+            return memo(*args, **kwargs)
+        update_wrapper(wrapper, func)
+        wrapper.cache_info = memo.info
+        wrapper.cache_clear = memo.clear
+        _caches.add(wrapper)
+        return wrapper
+    return decorator
+
+
+def pure(func):
+    '''
+        For functions whose result only depends on their arguments
+    '''
+    return cache()(func)
+
+
+def report():
+    '''
+        One line summary of every cached function
+    '''
+    parts = []
+    for wrapper in sorted(_caches, key=lambda w: w.__qualname__):
+        info = wrapper.cache_info()
+        parts.append('{} {}/{} hits, {} kept'.format(
+            wrapper.__qualname__, info.hits, info.hits + info.misses, info.currsize))
+    if not parts:
+        return 'Caches: none'
+    return 'Caches: ' + ', '.join(parts)
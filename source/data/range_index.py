@@ -0,0 +1,204 @@
+from .formula import colval
+
+'''
+    Range references (eg sum($A$1:A500)) are kept as rectangles rather than
+    expanded to every cell they cover. Each column keeps an interval index
+    over rows, and a changed cell finds the formulas reading it with a
+    stabbing query on its column (a changed block of rows with an overlap
+    query).
+'''
+
+# Intervals added since the last rebuild are scanned linearly until there
+# are this many of them
+REBUILD_THRESHOLD = 256
+
+
+class _Node:
+
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, center, intervals):
+        self.center = center
+        self.by_start = sorted(intervals, key=lambda i: i[0])
+        self.by_end = sorted(intervals, key=lambda i: i[1], reverse=True)
+        self.left = None
+        self.right = None
+
+
+def _build_tree(intervals):
+    '''
+        Centered interval tree, built without recursion
+    '''
+    if not intervals:
+        return None
+    root = None
+    stack = [(intervals, None, None)]
+    while stack:
+        items, parent, side = stack.pop()
+        points = sorted([i[0] for i in items] + [i[1] for i in items])
+        center = points[len(points) // 2]
+        left = [i for i in items if i[1] < center]
+        right = [i for i in items if i[0] > center]
+        here = [i for i in items if i[0] <= center <= i[1]]
+        node = _Node(center, here)
+        if parent is None:
+            root = node
+        else:
+            setattr(parent, side, node)
+        if left:
+            stack.append((left, node, 'left'))
+        if right:
+            stack.append((right, node, 'right'))
+    return root
+
+
+class IntervalIndex:
+    '''
+        Closed intervals (start, end, owner) on one axis
+    '''
+
+    def __init__(self):
+        self.tree = None
+        self.built = set()
+        self.pending = set()
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.built) - len(self.removed) + len(self.pending)
+
+    def add(self, start, end, owner):
+        item = (start, end, owner)
+        if item in self.removed:
+            self.removed.discard(item)
+        elif item not in self.built:
+            self.pending.add(item)
+
+    def remove(self, start, end, owner):
+        item = (start, end, owner)
+        if item in self.pending:
+            self.pending.discard(item)
+        elif item in self.built:
+            self.removed.add(item)
+        if len(self.removed) > REBUILD_THRESHOLD:
+            self._rebuild()
+
+    def _rebuild(self):
+        self.built = (self.built - self.removed) | self.pending
+        self.removed = set()
+        self.pending = set()
+        self.tree = _build_tree(list(self.built))
+
+    def stab(self, point):
+        '''
+            Yields the owner of every interval containing point
+        '''
+        if len(self.pending) > REBUILD_THRESHOLD:
+            self._rebuild()
+        removed = self.removed
+        node = self.tree
+        while node is not None:
+            if point < node.center:
+                for item in node.by_start:
+                    if item[0] > point:
+                        break
+                    if item not in removed:
+                        yield item[2]
+                node = node.left
+            elif point > node.center:
+                for item in node.by_end:
+                    if item[1] < point:
+                        break
+                    if item not in removed:
+                        yield item[2]
+                node = node.right
+            else:
+                for item in node.by_start:
+                    if item not in removed:
+                        yield item[2]
+                node = None
+        for start, end, owner in self.pending:
+            if start <= point <= end:
+                yield owner
+
+    def overlap(self, start, end):
+        '''
+            Yields the owner of every interval sharing a point with
+            start..end (an owner may come up more than once)
+        '''
+        if len(self.pending) > REBUILD_THRESHOLD:
+            self._rebuild()
+        removed = self.removed
+        stack = [self.tree] if self.tree is not None else []
+        while stack:
+            node = stack.pop()
+            if end < node.center:
+                for item in node.by_start:
+                    if item[0] > end:
+                        break
+                    if item not in removed:
+                        yield item[2]
+                if node.left is not None:
+                    stack.append(node.left)
+            elif start > node.center:
+                for item in node.by_end:
+                    if item[1] < start:
+                        break
+                    if item not in removed:
+                        yield item[2]
+                if node.right is not None:
+                    stack.append(node.right)
+            else:
+                for item in node.by_start:
+                    if item not in removed:
+                        yield item[2]
+                if node.left is not None:
+                    stack.append(node.left)
+                if node.right is not None:
+                    stack.append(node.right)
+        for item_start, item_end, owner in self.pending:
+            if item_start <= end and start <= item_end:
+                yield owner
+
+
+class RangeIndex:
+    '''
+        Rectangles ((row1, row2), (col1, col2)) keyed by owning cell.
+        Columns are ints here, but cells are looked up by column name.
+    '''
+
+    def __init__(self):
+        self.columns = {}
+
+    def add(self, rect, owner):
+        (r1, r2), (c1, c2) = rect
+        for c in range(c1, c2 + 1):
+            col = colval(c)
+            if col not in self.columns:
+                self.columns[col] = IntervalIndex()
+            self.columns[col].add(r1, r2, owner)
+
+    def remove(self, rect, owner):
+        (r1, r2), (c1, c2) = rect
+        for c in range(c1, c2 + 1):
+            col = colval(c)
+            index = self.columns.get(col)
+            if index is not None:
+                index.remove(r1, r2, owner)
+                if len(index) == 0:
+                    del self.columns[col]
+
+    def stab(self, cell):
+        row, col = cell
+        index = self.columns.get(col)
+        if index is None:
+            return ()
+        return index.stab(row)
+
+    def overlap(self, col, start, end):
+        '''
+            Owners of rectangles covering any of rows start..end of col
+        '''
+        index = self.columns.get(col)
+        if index is None:
+            return ()
+        return index.overlap(start, end)
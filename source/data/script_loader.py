@@ -1,46 +1,230 @@
 import os
+import re
+import time
 
-from importlib import machinery, util
+from importlib import util
 
-def load_module(filename):
-    bn = os.path.basename(filename).split('.')[0]
+'''
+    Scripts in DECEL_SCRIPT_DIR are indexed by the names they define at the
+    top level, without running them. A script is only imported the first
+    time a formula or expression uses one of its names. Scripts whose names
+    can't be found by scanning (eg `from x import *`, or definitions inside
+    an `if` or `try`) are imported up front as before.
+
+    poll() notices scripts that changed on disk, so formulas using their
+    names can be recalculated without restarting.
+'''
+
+definition_re = re.compile(r'^(?:async\s+def|def|class)\s+(\w+)', re.M)
+assignment_re = re.compile(r'^(\w+(?:\s*,\s*\w+)*)\s*(?::[^=\n]*)?=(?!=)', re.M)
+import_re = re.compile(r'^(?:from\s+[\w.]+\s+)?import\s+(.+)$', re.M)
+compound_re = re.compile(r'^(?:if|try|for|while|with|async\s+for|async\s+with)\b', re.M)
 
-    #loader = importlib.machinery.SourceFileLoader(bn.replace('-', '_'), '/tmp/a-b.txt')
-    #>>> mod = loader.load_module()
+# Seconds between checks for changed scripts
+POLL_INTERVAL = 1.0
 
 
-    loader = machinery.SourceFileLoader(bn, filename)
-    spec = util.spec_from_loader( bn, loader )
-    module = util.module_from_spec( spec )
-    loader.exec_module(module)
+def load_module(filename):
+    '''
+        Imports the file with the standard source loader, which keeps its
+        compiled bytecode in __pycache__
+    '''
+    name = os.path.splitext(os.path.basename(filename))[0]
+    spec = util.spec_from_file_location(name, filename)
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
     return module
 
-class ScriptLoader:
 
-    bad_filenames = [
-            '__pycache__'
-            ]
+def scan_names(source):
+    '''
+        Names a script defines at the top level, or None if they can't be
+        found without running it
+    '''
+    if compound_re.search(source):
+        return None
+    names = set(definition_re.findall(source))
+    for targets in assignment_re.findall(source):
+        names.update(t.strip() for t in targets.split(','))
+    for items in import_re.findall(source):
+        items = items.split('#')[0].strip()
+        if '*' in items or items.startswith('(') and not items.endswith(')'):
+            return None
+        for item in items.strip('()').split(','):
+            parts = item.split()
+            if len(parts) == 3 and parts[1] == 'as':
+                names.add(parts[2])
+            elif parts:
+                names.add(parts[0].split('.')[0])
+    return names
+
+
+class ScriptVars(dict):
+    '''
+        Names from scripts that have been imported so far. Looking up a
+        name that belongs to a script not imported yet imports it.
+    '''
+
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+
+    def __missing__(self, name):
+        path = self.loader.index.get(name)
+        if path is None:
+            raise KeyError(name)
+        module = self.loader.modules.get(path)
+        if module is None:
+            module = self.loader.import_script(path)
+        if not hasattr(module, name):
+            raise KeyError(name)
+        value = getattr(module, name)
+        self[name] = value
+        return value
+
+
+class ScriptLoader:
 
     def __init__(self):
         dname = os.environ.get('DECEL_SCRIPT_DIR')
-        self.vars = {}
-        if dname:
-            paths = dname.split(os.pathsep)
-            for path in paths:
-                for filename in os.listdir(path):
-                    if filename not in ScriptLoader.bad_filenames:
-                        full_path = os.path.join(path, filename)
-                        module = load_module(full_path)
-                        self.load_module(module)
-
-    def load_module(self, module):
+        self.dirs = dname.split(os.pathsep) if dname else []
+        self.vars = ScriptVars(self)
+        self.index = {}
+        self.scanned = {}
+        self.modules = {}
+        self.module_names = {}
+        self.load_times = {}
+        self.last_poll = time.monotonic()
+        self.files = self._list_files()
+        self._build_index()
+
+    def _list_files(self):
+        files = []
+        for path in self.dirs:
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith('.py'):
+                    files.append(os.path.join(path, filename))
+        return files
+
+    def _scan(self, full_path):
+        mtime = os.stat(full_path).st_mtime_ns
+        with open(full_path) as f:
+            names = scan_names(f.read())
+        self.scanned[full_path] = (mtime, names)
+
+    def _build_index(self):
+        self.index = {}
+        eager = []
+        for full_path in self.files:
+            if full_path not in self.scanned:
+                self._scan(full_path)
+            names = self.scanned[full_path][1]
+            if names is None:
+                eager.append(full_path)
+                continue
+            for name in names:
+                if not (name.startswith('__') and name.endswith('__')):
+                    self.index[name] = full_path
+        for full_path in eager:
+            if full_path not in self.modules:
+                self.import_script(full_path)
+
+    def import_script(self, full_path):
+        start = time.perf_counter()
+        module = load_module(full_path)
+        self.load_times[full_path] = time.perf_counter() - start
+        self.modules[full_path] = module
+        self.load_module(module, full_path)
+        return module
+
+    def load_module(self, module, full_path=None):
+        names = set()
         for val in dir(module):
             if not (val.startswith('__') and val.endswith('__')):
-                self.vars[val] = getattr(module, val)
+                # A name defined in more than one script belongs to the last
+                if self.index.get(val, full_path) == full_path:
+                    self.vars[val] = getattr(module, val)
+                    names.add(val)
+        self.module_names[full_path] = names
+
+    def _forget(self, full_path):
+        '''
+            Drops a script and returns the names it provided
+        '''
+        names = self.module_names.pop(full_path, set())
+        self.modules.pop(full_path, None)
+        _, scanned = self.scanned.pop(full_path, (None, None))
+        if scanned:
+            names = names | scanned
+        return names
+
+    def poll(self, interval=POLL_INTERVAL):
+        '''
+            Checks the script directories for files added, removed or
+            modified since they were indexed, at most once per interval
+            seconds. Changed scripts are imported again when next used.
+            Returns the names whose meaning may have changed.
+        '''
+        now = time.monotonic()
+        if now - self.last_poll < interval:
+            return set()
+        self.last_poll = now
+
+        files = self._list_files()
+        changed_paths = []
+        for full_path in set(self.files) | set(files):
+            try:
+                mtime = os.stat(full_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            scanned = self.scanned.get(full_path)
+            if scanned is None or scanned[0] != mtime:
+                changed_paths.append(full_path)
+        if not changed_paths:
+            return set()
+
+        changed = set()
+        for full_path in changed_paths:
+            changed |= self._forget(full_path)
+            if full_path in files:
+                self._scan(full_path)
+                changed |= self.scanned[full_path][1] or set()
+        for name in changed:
+            self.vars.pop(name, None)
+        self.files = files
+        self._build_index()
+        for full_path in changed_paths:
+            changed |= self.module_names.get(full_path, set())
+        return changed
 
     def get_vars(self):
         return self.vars
 
+    def names(self):
+        '''
+            Every name the scripts provide, without importing them
+        '''
+        return set(self.index) | set(self.vars)
+
+    def stamp(self):
+        '''
+            Identifies the loaded scripts, formula results saved under a
+            different stamp may be out of date
+        '''
+        return [[f, os.stat(f).st_mtime_ns] for f in self.files]
+
+    def report(self):
+        '''
+            One line summary of what was imported and how long it took
+        '''
+        total = sum(self.load_times[f] for f in self.modules)
+        slowest = sorted(((f, self.load_times[f]) for f in self.modules), key=lambda i: i[1], reverse=True)
+        details = ', '.join('{} {:.3f}s'.format(os.path.basename(f), t) for f, t in slowest)
+        out = 'Scripts: {} of {} imported in {:.3f}s'.format(len(self.modules), len(self.files), total)
+        if details:
+            out += ' ({})'.format(details)
+        return out
+
 global _decel_script_loader
 _decel_script_loader = None
 
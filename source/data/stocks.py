@@ -1,4 +1,8 @@
-import yfinance as yf
+import os
+
+import pandas as pd
+
+from .tick_cache import TickCache, DEFAULT_TTL
 
 '''
     Decel offers a rich and comprehensive stock integration, which is
@@ -11,8 +15,22 @@ import yfinance as yf
         Ticker: (ex: AAPL)
         Period: 1d,5d,1mo,3mo,6mo,1y,2y,5y,10y,ytd,max
         Interval: 1m,2m,5m,15m,30m,60m,90m,1h,1d,5d,1wk,1mo,3mo
+
+    Downloads are cached on disk (see tick_cache.py), so recalculating only
+    goes to the network for data older than the ttl:
+        DECEL_TICK_CACHE_DIR - where the cache lives (~/.cache/decel/ticks)
+        DECEL_TICK_TTL - seconds downloaded data stays fresh (900)
+        DECEL_TICK_OFFLINE - if set, only cached data is used
 '''
 
+DEFAULT_PERIOD = '3mo'
+DEFAULT_INTERVAL = '1h'
+
+
+class StockException(Exception):
+    pass
+
+
 def get_or(*args):
     for arg in args:
         if arg:
@@ -20,35 +38,143 @@ def get_or(*args):
     return None
 
 
-def tick(ticker, period=None, interval=None, p=None, i=None):
-    rp = get_or(period, p, '3mo')
-    ri = get_or(interval, i, '1h')
+def split_download(data, tickers):
+    '''
+        {ticker : frame} from a download grouped by ticker, leaving out
+        tickers that came back empty
+    '''
+    frames = {}
+    for ticker in tickers:
+        if isinstance(data.columns, pd.MultiIndex):
+            if ticker not in data.columns.get_level_values(0):
+                continue
+            frame = data[ticker]
+        elif len(tickers) == 1:
+            frame = data
+        else:
+            continue
+        frame = frame.dropna(how='all')
+        if len(frame):
+            frames[ticker] = frame
+    return frames
+
+
+def yahoo_fetch(tickers, period, interval):
+    # Imported on first download rather than at startup, it is slow to import
+    import yfinance as yf
 
     # Below comments are from yfinance pip module and are unchanged
 
     data = yf.download(  # or pdr.get_data_yahoo(...
             # tickers list or string as well
-            tickers = ticker,
+            tickers = list(tickers),
 
             # use "period" instead of start/end
             # valid periods: 1d,5d,1mo,3mo,6mo,1y,2y,5y,10y,ytd,max
             # (optional, default is '1mo')
-            period = rp,
+            period = period,
 
             # fetch data by interval (including intraday if period < 60 days)
             # valid intervals: 1m,2m,5m,15m,30m,60m,90m,1h,1d,5d,1wk,1mo,3mo
             # (optional, default is '1d')
-            interval = ri,
+            interval = interval,
 
             # group by ticker (to access via data['SPY'])
             # (optional, default is 'column')
             group_by = 'ticker',
             auto_adjust = True,
+            progress = False,
         )
+    return split_download(data, tickers)
+
+
+global _fetcher
+_fetcher = yahoo_fetch
+
+def set_fetcher(fetcher):
+    '''
+        fetcher(tickers, period, interval) -> {ticker : DataFrame}, used in
+        place of Yahoo (eg by tests). Returns the previous one.
+    '''
+    global _fetcher
+    previous = _fetcher
+    _fetcher = fetcher
+    return previous
 
-    for index, row in data.iterrows():
-        pass
-        #raise Exception(row)
 
-    return data
+global _tick_cache
+_tick_cache = None
 
+def get_cache():
+    global _tick_cache
+    if not _tick_cache:
+        path = os.environ.get('DECEL_TICK_CACHE_DIR', os.path.join('~', '.cache', 'decel', 'ticks'))
+        ttl = float(os.environ.get('DECEL_TICK_TTL', DEFAULT_TTL))
+        _tick_cache = TickCache(os.path.expanduser(path), ttl)
+    return _tick_cache
+
+
+def is_offline():
+    return bool(os.environ.get('DECEL_TICK_OFFLINE'))
+
+
+def tick_key(ticker, period=None, interval=None, p=None, i=None):
+    return (str(ticker).strip().upper(), get_or(period, p, DEFAULT_PERIOD), get_or(interval, i, DEFAULT_INTERVAL))
+
+
+def fetch(tickers, period, interval):
+    '''
+        Downloads tickers and stores them in the cache
+    '''
+    frames = _fetcher(tickers, period, interval)
+    cache = get_cache()
+    for ticker, frame in frames.items():
+        cache.put((ticker, period, interval), frame)
+    return frames
+
+
+def prefetch(keys):
+    '''
+        keys - (ticker, period, interval) as given by tick_key
+
+        Downloads every key that isn't fresh in the cache, with one request
+        per period and interval
+    '''
+    if is_offline():
+        return
+    cache = get_cache()
+    groups = {}
+    for ticker, period, interval in keys:
+        if cache.get((ticker, period, interval)) is None:
+            groups.setdefault((period, interval), {})[ticker] = None
+    for (period, interval), tickers in groups.items():
+        try:
+            fetch(list(tickers), period, interval)
+        except Exception:
+            # Left to tick(), which falls back to the cache per ticker
+            pass
+
+
+def tick(ticker, period=None, interval=None, p=None, i=None):
+    key = tick_key(ticker, period, interval, p, i)
+    cache = get_cache()
+    frame = cache.get(key)
+    if frame is not None:
+        return frame
+    if is_offline():
+        frame = cache.get(key, stale=True)
+        if frame is None:
+            raise StockException('No cached data for {} {} {} (offline)'.format(*key))
+        return frame
+    try:
+        fetch([key[0]], key[1], key[2])
+    except Exception:
+        # Network trouble, fall back to the last download if there is one
+        frame = cache.get(key, stale=True)
+        if frame is None:
+            raise
+        return frame
+    frame = cache.get(key, stale=True)
+    if frame is None:
+        raise StockException('No data for {} {} {}'.format(*key))
+    return frame
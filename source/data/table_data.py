@@ -1,16 +1,37 @@
 import re
+import io
 import os
+import builtins
+import keyword
 import pandas as pd;
 import csv
 import json
+import numpy as np
+from collections import ChainMap
+from contextlib import contextmanager
 
 from .script_loader import get_loader
-from .formula import Formula, colval, has_tokens, colint
-from .dependency_tree import DependencyNode, DependencyTree
-from .stocks import tick
+from .formula import Formula, FillRegion, colval, has_tokens, colint, token_re
+from .dependency_tree import DependencyGraph
+from .cell_range import CellRange, range_functions
+from .cell_store import CellStore
+from .workbook import read_workbook, write_workbook
+from .journal import Journal, VALUE, FORMULA, CHILD, REMOVE, FILL, COLUMN, encode_column, decode_column, encode_value, decode_value
+from .stocks import tick, tick_key, prefetch
 
 unnamed_col = r'Unnamed: [0-9]+'
 
+# Text that can't evaluate to anything, so it's stored as is
+plain_text_re = r'[A-Za-z_][A-Za-z0-9_ ]*'
+
+# CSVs are read in chunks of rows. The first is small so the top of the
+# sheet can be shown right away.
+FIRST_CSV_CHUNK = 500
+CSV_CHUNK = 20000
+
+# Shorter runs of a filled formula aren't worth evaluating as a block
+MIN_FILL_REGION = 16
+
 global defaults
 defaults = {}
 
@@ -20,6 +41,51 @@ def add_func(f):
 
 add_func(tick)
 
+# Formulas calling these can give a different result every time, so their
+# saved values are never trusted
+volatile_functions = {'tick'}
+
+def values_equal(old, new):
+    '''
+        Used to stop recalculating once a value comes out unchanged.
+        NaN equals NaN, frames only equal themselves.
+    '''
+    if old is new:
+        return True
+    if isinstance(old, np.ndarray) and isinstance(new, np.ndarray):
+        try:
+            return np.array_equal(old, new, equal_nan=True)
+        except TypeError:
+            return np.array_equal(old, new)
+    array_types = (pd.DataFrame, pd.Series, np.ndarray, CellRange)
+    if isinstance(old, array_types) or isinstance(new, array_types):
+        return False
+    if isinstance(old, float) and isinstance(new, float):
+        if np.isnan(old) and np.isnan(new):
+            return True
+    try:
+        return bool(old == new)
+    except:
+        return False
+
+def column_array(values):
+    '''
+        Float array if every value is a number or empty, else object array
+    '''
+    numeric = True
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool) or not isinstance(v, (int, float, np.integer, np.floating)):
+            numeric = False
+            break
+    if numeric:
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    out = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        out[i] = v
+    return out
+
 def read_token(token):
     row_lock = False
     col_lock = False
@@ -39,6 +105,63 @@ def read_token(token):
     row = int(m.group(0))
     return row, row_lock, col, col_lock
 
+def range_str(r1, r2, c1, c2):
+    start = '{}{}'.format(colval(c1), r1)
+    if (r1, c1) == (r2, c2):
+        return start
+    return '{}:{}{}'.format(start, colval(c2), r2)
+
+def encode_cells(cells):
+    '''
+        (row, col) cells as comma separated tokens, with runs and
+        rectangles written as ranges, eg B2:B100000,D4
+    '''
+    by_col = {}
+    for row, col in cells:
+        by_col.setdefault(colint(col), set()).add(row)
+
+    # Runs of consecutive rows in each column, then columns sharing a run
+    runs = {}
+    for c in sorted(by_col):
+        rows = sorted(by_col[c])
+        start = prev = rows[0]
+        for r in rows[1:]:
+            if r != prev + 1:
+                runs.setdefault((start, prev), []).append(c)
+                start = r
+            prev = r
+        runs.setdefault((start, prev), []).append(c)
+
+    parts = []
+    for (r1, r2), cols in runs.items():
+        first = last = cols[0]
+        for c in cols[1:]:
+            if c != last + 1:
+                parts.append(range_str(r1, r2, first, last))
+                first = c
+            last = c
+        parts.append(range_str(r1, r2, first, last))
+    return ','.join(parts)
+
+def decode_cells(text):
+    '''
+        Inverse of encode_cells, also reads plain comma separated tokens
+    '''
+    for part in text.split(','):
+        if not part:
+            continue
+        if ':' in part:
+            start, end = part.split(':')
+            r1, _, c1, _ = read_token(start)
+            r2, _, c2, _ = read_token(end)
+            for c in range(c1, c2 + 1):
+                col = colval(c)
+                for r in range(r1, r2 + 1):
+                    yield r, col
+        else:
+            r, _, c, _ = read_token(part)
+            yield r, colval(c)
+
 class TableData:
     '''
         This will contain data for a given row
@@ -51,47 +174,132 @@ class TableData:
 
     def __init__(self, dataframe=None):
         if dataframe is None:
-            self.data = pd.DataFrame()
+            self.store = CellStore()
         else:
-            self.data = dataframe
+            self.store = CellStore.from_dataframe(dataframe)
         self.formulae = {}
-        self.dependencies = {}
+        self.graph = DependencyGraph()
         self.current_file = ''
-        self.tree = DependencyTree()
+        self.batch_depth = 0
+        self.pending = {}
+        self.unlinked = set()
+        self.journal = None
+        self.journal_error = None
+        self.script_refs = {}
 
     def clear_data(self):
-        self.data = pd.DataFrame()
+        self.store = CellStore()
         self.formulae = {}
-        self.dependencies = {}
+        self.graph = DependencyGraph()
+        self.unlinked = set()
+        self.script_refs = {}
+        self.close_journal()
 
     def force_update(self):
-        for row, rowdata in self.data.iterrows():
-            for col, value in rowdata.iteritems():
-                self.token_changed((row, col))
-        self.trigger_update()
+        '''
+            Recalculates every formula, in dependency order
+        '''
+        for cell, formula in self.iter_formulae():
+            self.token_changed(cell)
+        self.recalculate()
+
+    def recalculate_cells(self, cells):
+        '''
+            Recalculates the given cells and every formula feeding into them
+        '''
+        for cell in self.formula_precedents(cells):
+            self.token_changed(cell)
+        self.recalculate()
+
+    def _formulae_in_range(self, rect):
+        (r1, r2), (c1, c2) = rect
+        if r2 - r1 < len(self.formulae):
+            rows = [r for r in range(r1, r2+1) if r in self.formulae]
+        else:
+            rows = [r for r in self.formulae if r1 <= r <= r2]
+        for r in rows:
+            for col in self.formulae[r]:
+                if c1 <= colint(col) <= c2:
+                    yield (r, col)
+
+    def formula_precedents(self, cells):
+        '''
+            Formula cells among `cells` and everything they read, directly
+            or through other formulas
+        '''
+        stack = [cell for cell in cells if self._has_formula(*cell)]
+        seen = set(stack)
+        while stack:
+            cell = stack.pop()
+            cells, ranges = self.formulae[cell[0]][cell[1]].get_dependent_references(cell)
+            precedents = [p for p in cells if self._has_formula(*p)]
+            for rect in ranges:
+                precedents.extend(self._formulae_in_range(rect))
+            for p in precedents:
+                if p not in seen:
+                    seen.add(p)
+                    stack.append(p)
+        return seen
 
     def has_value(self, row, col):
-        if self._has_formula(col, row):
-            return True
-        if col not in self.data:
-            return False
-        val = self.data.get(col, {}).get(row, False)
-        if isinstance(val, float):
-            if pd.isna(val):
-                return False
-        return bool(val)
-
-    def get_cell_value(self, row, col):
         if self._has_formula(row, col):
-            return self.formulae[row][col].get_value()
-        out = self.data.get(row, {}).get(col, None)
-
-
-        # This makes no sense but sometimes numpy floats throw a fit
-        if isinstance(out, float):
-            out = float(out)
-
-        return out
+            return True
+        if self.pending and row in self.pending.get(col, ()):
+            return self.pending[col][row] is not None
+        return self.store.has(row, col)
+
+    def get_cell_value(self, col, row):
+        if self.pending and row in self.pending.get(col, ()):
+            return self.pending[col][row]
+        # Formula results are stored alongside plain values
+        return self.store.get(row, col)
+
+    def next_change(self, row, col, vertical, positive):
+        '''
+            Nearest cell from (row, col), with col as an int, going down or
+            right if positive, where cells go from empty to filled or the
+            other way round. Returns (row, col) or None.
+        '''
+        step = 1 if positive else -1
+        if vertical:
+            r = self.store.next_change_in_column(colval(col), row, step)
+            return None if r is None else (r, col)
+        c = self.store.next_change_in_row(row, col, step)
+        return None if c is None else (row, c)
+
+    def next_occupied(self, row, col, vertical, positive):
+        '''
+            Nearest filled cell past (row, col) in the same direction
+        '''
+        step = 1 if positive else -1
+        if vertical:
+            row += step
+        else:
+            col += step
+        if row < 0 or col < 0:
+            return None
+        if self.store.has(row, colval(col)):
+            return (row, col)
+        return self.next_change(row, col, vertical, positive)
+
+    def used_range(self):
+        '''
+            ((first row, last row), (first col, last col)), or None if the
+            sheet is empty
+        '''
+        rows = self.store.row_bounds()
+        cols = self.store.column_bounds()
+        if rows is None or cols is None:
+            return None
+        return (rows, cols)
+
+    def last_row(self):
+        used = self.used_range()
+        return None if used is None else used[0][1]
+
+    def last_col(self):
+        used = self.used_range()
+        return None if used is None else used[1][1]
 
     def get_cell_range_coords(self, start_pos, end_pos):
         output = []
@@ -103,12 +311,10 @@ class TableData:
         return output
 
     def get_cell_range(self, start_pos, end_pos):
-        output = []
-        coords = self.get_cell_range_coords(start_pos, end_pos)
-        for row, col in coords:
-                val = self.get_cell_value(col, row)
-                output.append(val)
-        return output
+        rows = sorted([start_pos[0], end_pos[0]])
+        cols = sorted([start_pos[1], end_pos[1]])
+        columns = [colval(c) for c in range(cols[0], cols[1]+1)]
+        return CellRange(self.store.get_block(rows[0], rows[1], columns))
 
     def get_formula(self, row, col):
         if self._has_formula(row, col):
@@ -124,34 +330,198 @@ class TableData:
         pass
 
     def update_value(self, row, col):
+        '''
+            Returns True if the cell's value changed
+        '''
         if self._has_formula(row, col):
             val = self.formulae[row][col].get_value()
-            self.set_value(row, col, val)
+            old = self.get_cell_value(col, row)
+            self._store_value(row, col, val)
+            return not values_equal(old, val)
+        return True
 
     def remove_formula(self, row, col):
         if row in self.formulae:
             if col in self.formulae[row]:
+                self._journal(REMOVE, self.cell_str((row, col)))
+                self._remove_script_refs((row, col), self.formulae[row][col])
                 del self.formulae[row][col]
+                self.unlinked.discard((row, col))
+                self._release_region((row, col))
+                self.graph.remove((row, col))
+                self.token_changed((row, col))
 
-    def add_dependency(self, lead_token, dependent_token):
-        if lead_token not in self.dependencies:
-            self.dependencies[lead_token] = {}
-        self.dependencies[lead_token][dependent_token] = True
+    def _remove_script_refs(self, cell, formula):
+        for name in formula.compiled.names:
+            cells = self.script_refs.get(name)
+            if cells is not None:
+                cells.discard(cell)
+                if not cells:
+                    del self.script_refs[name]
+
+    def reload_scripts(self):
+        '''
+            Picks up scripts changed on disk and marks only the formulas
+            using their names dirty. Returns the names that changed.
+        '''
+        changed = get_loader().poll()
+        for name in changed:
+            for cell in self.script_refs.get(name, ()):
+                self.token_changed(cell)
+        return changed
 
     def add_dependencies(self, formula):
-        tokens = formula.get_dependent_coordinates(formula.position)
-        f_pos = formula.position
-        for token in tokens:
-            self.add_dependency(token, f_pos)
+        cell = tuple(formula.position)
+        if self.batch_depth:
+            # Linked when the batch ends, where filled runs become regions
+            self.unlinked.add(cell)
+            return
+        self._release_region(cell)
+        self._link_cell(cell)
+
+    def _link_cell(self, cell):
+        cells, ranges = self.formulae[cell[0]][cell[1]].get_dependent_references(cell)
+        self.graph.set_precedents(cell, cells, ranges)
+
+    def _release_region(self, cell):
+        '''
+            Takes cell out of the region holding it, linking the rows
+            either side of it again
+        '''
+        region = self.graph.region_at(cell)
+        if region is None:
+            return
+        self.graph.remove_region(region)
+        row = cell[0]
+        for start, end in ((region.start, row - 1), (row + 1, region.end)):
+            if end - start + 1 >= MIN_FILL_REGION:
+                part = FillRegion(region.root, region.col, start, end)
+                if not part.reads_itself():
+                    self.graph.add_region(part)
+                    continue
+            for r in range(start, end + 1):
+                self._link_cell((r, region.col))
+
+    def _link_formulae(self):
+        '''
+            Links the formulas added during a batch. Runs of a filled
+            formula become one region each, everything else is linked cell
+            by cell.
+        '''
+        cells = {cell for cell in self.unlinked if self._has_formula(*cell)}
+        self.unlinked = set()
+        graph = self.graph
+        # Formulas of the same root already linked next to them join the
+        # run, eg the cell a fill started from
+        stack = list(cells)
+        while stack:
+            row, col = stack.pop()
+            root = self.formulae[row][col].root()
+            for cell in ((row - 1, col), (row + 1, col)):
+                if cell not in cells and cell in graph.precedents and \
+                        self.formulae[cell[0]][cell[1]].root() is root:
+                    cells.add(cell)
+                    stack.append(cell)
+        # Regions written into are taken apart and found again
+        for region in {graph.region_at(cell) for cell in cells} - {None}:
+            graph.remove_region(region)
+            cells.update(region.cells)
+        for region in self.find_fill_regions(cells):
+            graph.add_region(region)
+            for cell in region.cells:
+                cells.discard(cell)
+                if cell in graph.precedents:
+                    graph.remove(cell)
+        for cell in cells:
+            self._link_cell(cell)
 
     def token_changed(self, cell):
-        for child in self.dependencies.get(cell, {}):
-            self.tree.add_dependency(cell, child)
-
-    def trigger_update(self):
-        for row, col in self.tree.yield_values():
-            self.update_value(row, col)
-        self.tree.shake()
+        self.graph.mark_dirty(cell)
+
+    def update_region(self, region):
+        '''
+            Returns True if any value in the region changed
+        '''
+        values = region.get_values()
+        if values is None:
+            changed = False
+            for row, col in region.cells:
+                changed = self.update_value(row, col) or changed
+            return changed
+        c = colint(region.col)
+        old = self.get_cell_range((region.start, c), (region.end, c)).numeric()
+        self._store_values(region.col, region.rows(), values)
+        return old is None or not values_equal(old.ravel(), values)
+
+    def find_fill_regions(self, cells):
+        families = {}
+        for row, col in cells:
+            formula = self.get_formula(row, col)
+            if formula is None:
+                continue
+            root = formula.root()
+            if not root.compiled.vectorizable:
+                continue
+            key = (id(root), col)
+            if key not in families:
+                families[key] = (root, col, [])
+            families[key][2].append(row)
+
+        regions = []
+        for root, col, rows in families.values():
+            rows.sort()
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i] != rows[i-1] + 1:
+                    if i - start >= MIN_FILL_REGION:
+                        region = FillRegion(root, col, rows[start], rows[i-1])
+                        if not region.reads_itself():
+                            regions.append(region)
+                    start = i
+        return regions
+
+    def evaluate_node(self, node):
+        if isinstance(node, FillRegion):
+            return self.update_region(node)
+        return self.update_value(*node)
+
+    def recalculate(self):
+        if self.unlinked and not self.batch_depth:
+            self._link_formulae()
+        if not self.graph.has_dirty():
+            return
+        self.graph.recalculate(self.evaluate_node, self.prefetch_ticks)
+
+    def formula_namespace(self):
+        '''
+            Names available to formulas: script names first, then range
+            functions and the built in ones (eg tick)
+        '''
+        return ChainMap(get_loader().get_vars(), range_functions, defaults)
+
+    def prefetch_ticks(self, affected):
+        '''
+            Downloads what the tick() formulas among the affected cells
+            need, one request per period and interval rather than one per
+            formula. Only the arguments of each tick() call are evaluated
+            here, recalculation then reads the results from the cache.
+        '''
+        cells = self.script_refs.get('tick')
+        if not cells:
+            return
+        namespace = self.formula_namespace()
+        if namespace['tick'] is not tick:
+            # Replaced by a script
+            return
+        keys = []
+        for row, col in sorted(cells):
+            if (row, col) in affected:
+                for args, kwargs in self.formulae[row][col].call_arguments('tick', namespace):
+                    try:
+                        keys.append(tick_key(*args, **kwargs))
+                    except TypeError:
+                        pass
+        prefetch(keys)
 
     def make_formula(self, row, col, formula):
         new_formula = Formula((row, col), formula, self)
@@ -159,14 +529,34 @@ class TableData:
         return new_formula
 
     def add_formula(self, row, col, new_formula):
+        self._register_formula(row, col, new_formula)
+        if self.batch_depth:
+            # Evaluated by the recalculation at the end of the batch
+            self.token_changed((row, col))
+            return
+        val = new_formula.get_value()
+        self._store_value(row, col, val)
+        self.token_changed((row, col))
+
+    def _register_formula(self, row, col, new_formula):
         if row not in self.formulae:
             self.formulae[row] = {}
+        old = self.formulae[row].get(col)
+        if old is not None:
+            self._remove_script_refs((row, col), old)
         self.formulae[row][col] = new_formula
-
-        val = new_formula.get_value()
+        for name in new_formula.compiled.names:
+            if name not in self.script_refs:
+                self.script_refs[name] = set()
+            self.script_refs[name].add((row, col))
+
+        if self.journal is not None:
+            root = new_formula.root()
+            if root is new_formula:
+                self._journal(FORMULA, self.cell_str((row, col)), root.formula)
+            else:
+                self._journal(CHILD, self.cell_str((row, col)), self.cell_str(root.position), root.formula)
         self.add_dependencies(new_formula)
-        self.set_value(row, col, val)
-        self.token_changed((row, col))
 
     def set_string_value(self, r, c, val):
         col = colval(c)
@@ -177,37 +567,11 @@ class TableData:
             self.make_formula(r, col, val)
         else:
             try:
-                local_vars = defaults
-                local_vars.update(get_loader().get_vars())
+                # Script names first, imported only if the expression uses them
+                local_vars = ChainMap(get_loader().get_vars(), defaults)
                 value = eval(val, {}, local_vars)
                 if isinstance(value, pd.DataFrame):
-                    cols = value.columns
-                    rowind = 0
-                    has_index = False
-                    for ind, row in value.iterrows():
-                        rowind += 1
-                        nrow = r + rowind
-                        colrange = len(cols)
-
-                        start_col_offset = 0
-
-                        if has_index or not isinstance(ind, int):
-                            has_index = True
-                            self.set_value(nrow, colval(c), ind)
-                            start_col_offset = 1
-                        else:
-                            rowind = ind
-
-                        for i in range(len(cols)):
-                            col_ = cols[i]
-                            val = row[col_]
-                            ncol = colval(c + i + start_col_offset)
-                            self.set_value(nrow, ncol, val)
-
-                    for i in range(len(cols)):
-                        ncol = colval(c + i + start_col_offset)
-                        self.set_value(r, ncol, cols[i])
-
+                    self.place_dataframe(r, col, value)
                     return
                 try:
                     v = float(value)
@@ -218,13 +582,166 @@ class TableData:
                 self.set_value(r, col, val)
 
     def set_value(self, row, col, value):
-        self.data.at[row, col] = value
+        self._journal(VALUE, self.cell_str((row, col)), encode_value(value))
+        if self.batch_depth:
+            if col not in self.pending:
+                self.pending[col] = {}
+            self.pending[col][row] = value
+            return
+        self._store_value(row, col, value)
         self.token_changed((row, col))
 
+    def set_column(self, col, rows, values):
+        '''
+            Writes an array of values to rows of one column in one step,
+            keeping the array's dtype
+        '''
+        rows = np.asarray(rows).tolist()
+        pending = self.pending.get(col)
+        if pending:
+            written = list(pending)
+            for i in np.flatnonzero(np.isin(written, rows)):
+                del pending[written[i]]
+        self._journal_column(col, rows, values)
+        self._store_values(col, rows, values)
+        self.graph.mark_dirty_rows(col, rows)
+        if not self.batch_depth:
+            self.recalculate()
+
+    def place_dataframe(self, row, col, frame):
+        '''
+            Header on `row` starting at `col`, rows of the frame below it.
+            The index goes in the first column unless it's just row numbers.
+        '''
+        c = colint(col)
+        rows = np.arange(row + 1, row + 1 + len(frame))
+        columns = []
+        index = frame.index
+        if isinstance(index, pd.DatetimeIndex):
+            columns.append((None, index.to_pydatetime()))
+        elif index.dtype.kind not in 'iu':
+            columns.append((None, index.to_numpy()))
+        for i, name in enumerate(frame.columns):
+            series = frame.iloc[:, i]
+            if series.dtype.kind in 'mM':
+                # Timestamps and Timedeltas, as set_value would store them
+                columns.append((name, series.astype(object).to_numpy()))
+            else:
+                columns.append((name, series.to_numpy()))
+        with self.batch():
+            for i, (name, values) in enumerate(columns):
+                target = colval(c + i)
+                if name is not None:
+                    self.set_value(row, target, name)
+                self.set_column(target, rows, values)
+
+    def fill(self, row, col, rows, cols):
+        '''
+            Copies (row, col) to every cell of rows x cols, where rows is a
+            range and cols a list of neighbouring column names. A formula
+            is filled with children of its root, which are evaluated
+            together by the recalculation at the end.
+        '''
+        rows = list(rows)
+        if not rows or not cols:
+            return
+        formula = self.get_formula(row, col)
+        start = range_str(rows[0], rows[-1], colint(cols[0]), colint(cols[-1]))
+        self._journal(FILL, self.cell_str((row, col)), start if ':' in start else start + ':' + start)
+
+        # One record above covers every cell written here
+        journal, self.journal = self.journal, None
+        try:
+            with self.batch():
+                if formula is not None:
+                    root = formula.root()
+                    for target in cols:
+                        for r in rows:
+                            self.add_formula(r, target, root.make_child((r, target)))
+                else:
+                    values = np.repeat(column_array([self.get_cell_value(col, row)]), len(rows))
+                    for target in cols:
+                        for r in rows:
+                            self.remove_formula(r, target)
+                        self.set_column(target, rows, values)
+        finally:
+            self.journal = journal
+
+    def paste(self, row, col, cells):
+        '''
+            cells - (row offset, col offset) -> Formula or value, placed
+            relative to (row, col)
+        '''
+        c = colint(col)
+        columns = {}
+        with self.batch():
+            for (dr, dc), value in cells.items():
+                target = colval(c + dc)
+                r = row + dr
+                if isinstance(value, Formula):
+                    self.add_formula(r, target, value.make_child((r, target)))
+                else:
+                    self.remove_formula(r, target)
+                    columns.setdefault(target, {})[r] = value
+            for target, values in columns.items():
+                rows = sorted(values)
+                self.set_column(target, rows, column_array([values[r] for r in rows]))
+
+    def set_values(self, row, col, values):
+        '''
+            Writes a 2-D block of values with its top left at (row, col)
+            and recalculates once
+        '''
+        values = np.asarray(values, dtype=object)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        c = colint(col)
+        rows = range(row, row + values.shape[0])
+        with self.batch():
+            for i in range(values.shape[1]):
+                name = colval(c + i)
+                self._journal_column(name, rows, values[:, i])
+                if name not in self.pending:
+                    self.pending[name] = {}
+                self.pending[name].update(zip(rows, values[:, i]))
+
+    @contextmanager
+    def batch(self):
+        '''
+            Writes made inside are buffered, then stored column by column
+            with a single recalculation at the end. Batches can be nested.
+        '''
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self._commit_batch()
+
+    def _commit_batch(self):
+        pending = self.pending
+        self.pending = {}
+        for col, values in pending.items():
+            rows = sorted(values)
+            column = [values[r] for r in rows]
+            self._store_values(col, rows, column_array(column))
+            self.graph.mark_dirty_rows(col, rows)
+        self.recalculate()
+
+    def _store_value(self, row, col, value):
+        self.store.set(row, col, value)
+
+    def _store_values(self, col, rows, values):
+        self.store.set_many(col, rows, values)
+
     def load_file(self, filepath):
         if filepath.endswith('.dc'):
             self.load_dc(filepath)
             return
+        if filepath.endswith('.dcb'):
+            self.load_dcb(filepath)
+            return
         if filepath.endswith('.csv'):
             self.load_csv(filepath)
             return
@@ -238,50 +755,168 @@ class TableData:
         formulae = decel_data['formulae']
         csv_data = decel_data['csv']
 
-        tmp_csv = os.path.join(os.getcwd(), 'tmp_csv.csv')
-        with open(tmp_csv, 'w+') as f:
-            f.write(csv_data)
-
-        self.load_csv(tmp_csv)
-
-        for f in formulae:
-            formula_data = formulae[f]
-            r, _, c, _ = read_token(f)
-            cell = (r, c)
-            formula = formula_data['formula']
-            t_data = [read_token(t) for t in formula_data['children'].split(',')]
-            children = [(t[0], t[2]) for t in t_data]
-            
-            base = self.make_formula(r, colval(c), formula)
-            for cr, cc in children:
-                child_formula = base.make_child((cr, colval(cc)))
-                self.add_formula(cr, colval(cc), child_formula)
-
-        #os.remove(tmp_csv)
+        self.clear_data()
+        if csv_data.strip():
+            for _ in self._iter_load_csv(io.StringIO(csv_data), len(csv_data)):
+                pass
+        self.load_formula_data(formulae, decel_data.get('stamp'))
         self.set_filename(filepath)
+        self.open_journal()
 
-    def load_csv(self, filepath):
-        body = []
-
-        new_df = pd.DataFrame()
-        csv_df = pd.read_csv(filepath, header=None)
-        p_cols = csv_df.columns
-
+    def load_dcb(self, filepath):
+        '''
+            Numeric columns stay mapped to the file until they're written to
+        '''
         self.clear_data()
-        self.data = new_df
-        for i in range(len(p_cols)):
-            csv_col = p_cols[i]
-            col_name = colval(i)
-
-            for r in range(len(csv_df)):
-                raw_val = csv_df.at[r, csv_col]
-                if pd.isna(raw_val):
-                    self.set_value(r, i, None)
+        self.store, formulae, stamp = read_workbook(filepath)
+        self.load_formula_data(formulae, stamp)
+        self.set_filename(filepath)
+        self.open_journal()
+
+    def load_formula_data(self, formulae, stamp=None):
+        '''
+            formulae - formula table, see get_formula_jsondata
+            stamp - calc_stamp when the file was saved
+
+            Saved values are kept when the stamp still matches. Only
+            volatile formulas and cells whose value couldn't be saved as a
+            number are recalculated.
+        '''
+        cached = stamp is not None and stamp == self.calc_stamp()
+        with self.batch():
+            for f in formulae:
+                formula_data = formulae[f]
+                r, _, c, _ = read_token(f)
+                base = Formula((r, colval(c)), formula_data['formula'], self)
+                cells = [base.position]
+                cells.extend(cell for cell in decode_cells(formula_data['children'])
+                             if cell != base.position)
+                if not cached or self.is_volatile(base):
+                    stale = cells
                 else:
-                    v = str(raw_val).strip(' ')
-                    self.set_string_value(r, i, v)
+                    stale = self._without_cached_values(cells)
+                for cell in cells:
+                    formula = base if cell == base.position else base.make_child(cell)
+                    self._register_formula(cell[0], cell[1], formula)
+                for cell in stale:
+                    self.token_changed(cell)
+
+    def _without_cached_values(self, cells):
+        '''
+            Cells that don't hold a saved number
+        '''
+        by_col = {}
+        for row, col in cells:
+            by_col.setdefault(col, []).append(row)
+        missing = []
+        for col, rows in by_col.items():
+            start = min(rows)
+            values = self.store.get_column(col, start, max(rows))
+            offsets = np.asarray(rows) - start
+            if values.dtype.kind == 'f':
+                numeric = ~np.isnan(values[offsets])
+            else:
+                numeric = np.array([isinstance(v, (int, float)) and not isinstance(v, bool)
+                                    for v in values[offsets]], dtype=bool)
+            missing.extend((rows[i], col) for i in np.flatnonzero(~numeric))
+        return missing
 
+    def is_volatile(self, formula):
+        return not formula.compiled.names.isdisjoint(volatile_functions)
+
+    def calc_stamp(self):
+        '''
+            Saved with formula results, which are only reused if this is
+            the same when the file is opened
+        '''
+        return {'scripts' : get_loader().stamp()}
+
+    def load_csv(self, filepath):
+        for _ in self.iter_load_csv(filepath):
+            pass
+
+    def iter_load_csv(self, filepath, first_chunk=FIRST_CSV_CHUNK, chunk_size=CSV_CHUNK):
+        '''
+            Loads the file a chunk of rows at a time, yielding
+            (rows loaded, fraction of the file read) after each chunk
+        '''
+        self.clear_data()
+        size = os.path.getsize(filepath)
+        with open(filepath) as f:
+            yield from self._iter_load_csv(f, size, first_chunk, chunk_size)
         self.set_filename(filepath)
+        self.open_journal()
+
+    def _iter_load_csv(self, f, size, first_chunk=FIRST_CSV_CHUNK, chunk_size=CSV_CHUNK):
+        row = 0
+        chunks = 0
+        reader = pd.read_csv(f, header=None, chunksize=chunk_size)
+        rows = first_chunk
+        while True:
+            try:
+                csv_df = reader.get_chunk(rows)
+            except StopIteration:
+                break
+            p_cols = csv_df.columns
+            with self.batch():
+                for i in range(len(p_cols)):
+                    self._load_csv_column(i, csv_df[p_cols[i]], row)
+            row += len(csv_df)
+            rows = chunk_size
+            chunks += 1
+            yield row, (f.tell() / size if size else 1)
+
+        # Formulas may read rows from chunks loaded after them
+        if chunks > 1 and self.formulae:
+            self.force_update()
+
+    def _known_names(self):
+        names = set(dir(builtins))
+        names.update(defaults)
+        names.update(get_loader().names())
+        return names
+
+    def _is_plain_text(self, text, known_names):
+        for word in text.split():
+            if word in known_names or keyword.iskeyword(word):
+                return False
+        return True
+
+    def _load_csv_column(self, c, series, start_row=0):
+        '''
+            Numbers and plain text are written to the store in one step.
+            Only cells with tokens or anything else that could be an
+            expression go through set_string_value.
+        '''
+        col = colval(c)
+        rows = np.arange(start_row, start_row + len(series))
+        if series.dtype.kind in 'biuf':
+            self.store.set_many(col, rows, series.to_numpy(dtype=float, na_value=np.nan))
+            return
+
+        present = series.notna().to_numpy()
+        text = series.astype(str).str.strip(' ')
+        numbers = pd.to_numeric(text, errors='coerce').to_numpy(dtype=float)
+        numeric = present & np.isfinite(numbers)
+        formula = present & ~numeric & text.str.contains(token_re).to_numpy()
+        maybe_plain = present & ~numeric & ~formula & text.str.fullmatch(plain_text_re).to_numpy()
+
+        text = text.to_numpy()
+        known_names = self._known_names()
+        plain = np.zeros(len(series), dtype=bool)
+        for r in np.flatnonzero(maybe_plain):
+            plain[r] = self._is_plain_text(text[r], known_names)
+
+        if plain.any():
+            values = np.full(len(series), None, dtype=object)
+            values[numeric] = numbers[numeric]
+            values[plain] = text[plain]
+        else:
+            values = np.where(numeric, numbers, np.nan)
+        self.store.set_many(col, rows, values)
+
+        for r in np.flatnonzero(present & ~numeric & ~plain):
+            self.set_string_value(start_row + int(r), c, text[r])
 
     def filename(self):
         return self.current_file
@@ -300,11 +935,113 @@ class TableData:
             self.save_csv(fname)
         if fname.endswith('.dc'):
             self.save_dc(fname)
+        if fname.endswith('.dcb'):
+            self.save_dcb(fname)
+        self.start_journal()
+
+    def _journal(self, *record):
+        if self.journal is not None:
+            try:
+                self.journal.append(list(record))
+            except OSError as e:
+                self._stop_journal(e)
+
+    def _journal_column(self, col, rows, values):
+        '''
+            One record for a block of values written to a column
+        '''
+        if self.journal is not None:
+            self._journal(COLUMN, col, *encode_column(rows, values))
+
+    def _stop_journal(self, error):
+        '''
+            Edits can't be journaled (eg the directory is read only), so
+            carry on without. journal_error is left for the UI to show.
+        '''
+        journal, self.journal = self.journal, None
+        self.journal_error = 'Journal off: {}'.format(error)
+        if journal is not None and journal.file is not None:
+            try:
+                journal.file.close()
+            except OSError:
+                pass
+
+    def open_journal(self):
+        '''
+            Replays edits made since the file was last saved, then keeps
+            journaling new ones. The journal file is only written once
+            there is an edit.
+        '''
+        journal = Journal(self.current_file)
+        try:
+            records = journal.read()
+        except OSError as e:
+            self._stop_journal(e)
+            return
+        if records:
+            self.replay_journal(records)
+        self.journal = journal
+
+    def start_journal(self):
+        '''
+            The file was just written, so older edits are no longer needed
+        '''
+        if self.journal is None or self.journal.filepath != self.current_file:
+            self.close_journal()
+            self.journal = Journal(self.current_file)
+        try:
+            self.journal.start()
+        except OSError as e:
+            self._stop_journal(e)
+
+    def sync_journal(self):
+        if self.journal is not None:
+            try:
+                self.journal.sync()
+            except OSError as e:
+                self._stop_journal(e)
+
+    def close_journal(self):
+        if self.journal is not None:
+            try:
+                self.journal.close()
+            except OSError as e:
+                self._stop_journal(e)
+            self.journal = None
+
+    def replay_journal(self, records):
+        roots = {}
+        with self.batch():
+            for record in records:
+                op = record[0]
+                if op == COLUMN:
+                    rows, values = decode_column(*record[2:])
+                    self.set_column(record[1], rows, values)
+                    continue
+                r, _, c, _ = read_token(record[1])
+                col = colval(c)
+                if op == VALUE:
+                    self.set_value(r, col, decode_value(record[2]))
+                elif op == FORMULA:
+                    self.make_formula(r, col, record[2])
+                elif op == CHILD:
+                    key = (record[2], record[3])
+                    if key not in roots:
+                        rr, _, rc, _ = read_token(record[2])
+                        roots[key] = Formula((rr, colval(rc)), record[3], self)
+                    self.add_formula(r, col, roots[key].make_child((r, col)))
+                elif op == REMOVE:
+                    self.remove_formula(r, col)
+                elif op == FILL:
+                    start, end = record[2].split(':')
+                    r1, _, c1, _ = read_token(start)
+                    r2, _, c2, _ = read_token(end)
+                    self.fill(r, col, range(r1, r2 + 1), [colval(i) for i in range(c1, c2 + 1)])
 
     def save_csv(self, filepath):
         if not filepath:
             filepath = self.current_file
-        self.data.to_csv(filepath, header=None, index=None)
+        self.store.to_dataframe().to_csv(filepath, header=None, index=None)
 
     def iter_formulae(self):
         for r in self.formulae:
@@ -339,11 +1076,8 @@ class TableData:
                 children[ppos].append(cell)
 
         for f in root_formulae:
-            # Need to turn this into a range or something. String gets too big
             fdata = root_formulae[f]
-            child_cells = children[f]
-            childstring = ','.join([self.cell_str(cell) for cell in child_cells])
-            fdata['children'] = childstring
+            fdata['children'] = encode_cells(children[f])
 
         output = {}
 
@@ -356,26 +1090,24 @@ class TableData:
         output_data = {}
         decel_data = {}
 
+        self.recalculate()
         formula_data = self.get_formula_jsondata()
         decel_data['formulae'] = formula_data
+        decel_data['stamp'] = self.calc_stamp()
 
-        current = os.getcwd()
-        tmp_csv = os.path.join(current, 'tmp_csv.csv')
-
-        self.save_csv(tmp_csv)
-        with open(tmp_csv) as f:
-            content = f.read()
-            decel_data['csv'] = content
-        os.remove(tmp_csv)
+        buf = io.StringIO()
+        self.store.to_dataframe().to_csv(buf, header=None, index=None)
+        decel_data['csv'] = buf.getvalue()
 
         output_data['decel'] = decel_data
 
         dest_path = filepath
         if not os.path.exists(filepath):
-            dest_path = os.path.join(current, filepath)
+            dest_path = os.path.join(os.getcwd(), filepath)
 
         with open(dest_path, 'w+') as f:
             json.dump(output_data, f)
 
-
-
+    def save_dcb(self, filepath):
+        self.recalculate()
+        write_workbook(filepath, self.store, self.get_formula_jsondata(), self.calc_stamp())
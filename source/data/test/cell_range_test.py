@@ -0,0 +1,33 @@
+import numpy as np
+
+from ..cell_range import CellRange, range_functions
+from .formula_test import get_column_table
+
+def test_range_behaves_like_list():
+    r = CellRange(np.array([[1.0, 2.0], [3.0, 4.0]]))
+    assert len(r) == 4
+    assert list(r) == [1, 2, 3, 4]
+    assert r[2] == 3
+    assert r.shape == (2, 2)
+
+def test_range_arithmetic():
+    r = CellRange(np.array([[1.0], [2.0]]))
+    assert ((r * 2) + r).tolist() == [[3.0], [6.0]]
+    assert (10 - r).tolist() == [[9.0], [8.0]]
+
+def test_range_aggregates_skip_blanks():
+    r = CellRange(np.array([[1.0], [None], [5.0]], dtype=object))
+    assert range_functions['sum'](r) == 6
+    assert range_functions['max'](r) == 5
+    assert range_functions['sum']([1, 2]) == 3
+
+def test_range_formula():
+    td = get_column_table([float(i) for i in range(10)])
+    f = td.make_formula(0, 'B', 'sum(A1:A4) + len($A$0:$A$9)')
+    assert f.get_value() == 20
+
+def test_aggregate_keywords_use_builtin():
+    td = get_column_table([1.0, 3.0, 2.0])
+    assert td.make_formula(0, 'B', 'max(A0:A2, default=0)').get_value() == 3
+    assert td.make_formula(0, 'C', 'min(A0:A2, key=lambda x: -x)').get_value() == 3
+    assert td.make_formula(0, 'D', 'sum(A0:A2, start=10)').get_value() == 16
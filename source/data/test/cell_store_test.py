@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from ..cell_store import CellStore, CHUNK_SIZE
+
+def test_point_reads_and_writes():
+    store = CellStore()
+    store.set(0, 'A', 1)
+    store.set(CHUNK_SIZE * 3 + 5, 'A', 2.5)
+    store.set(2, 'B', 'text')
+    assert store.get(0, 'A') == 1
+    assert store.get(CHUNK_SIZE * 3 + 5, 'A') == 2.5
+    assert store.get(2, 'B') == 'text'
+    assert store.get(1, 'A') is None
+    assert not store.has(1, 'A')
+    store.set(0, 'A', None)
+    assert not store.has(0, 'A')
+
+def test_chunk_widens_types():
+    store = CellStore()
+    store.set(0, 'A', 1)
+    store.set(1, 'A', 2.5)
+    assert store.get(0, 'A') == 1.0
+    store.set(2, 'A', 'x')
+    assert store.get(1, 'A') == 2.5
+    assert store.get(2, 'A') == 'x'
+    assert store.get(3, 'A') is None
+
+def test_block_reads():
+    store = CellStore()
+    store.set_many('A', range(10), np.arange(10.0))
+    store.set(3, 'B', 'x')
+    block = store.get_block(8, 11, ['A'])
+    assert block.dtype == float
+    assert block[:2, 0].tolist() == [8.0, 9.0]
+    assert np.isnan(block[2:, 0]).all()
+    mixed = store.get_block(2, 4, ['A', 'B'])
+    assert mixed.tolist() == [[2.0, None], [3.0, 'x'], [4.0, None]]
+
+def test_dataframe_round_trip():
+    frame = pd.DataFrame({'A': [1.0, 2.0, np.nan], 'C': ['x', None, 'z']})
+    out = CellStore.from_dataframe(frame).to_dataframe()
+    assert list(out.columns) == ['A', 'B', 'C']
+    assert out['A'].tolist()[:2] == [1.0, 2.0]
+    assert out['C'].tolist() == ['x', None, 'z']
+
+def test_next_change():
+    store = CellStore()
+    store.set_many('A', np.arange(10, 3000), np.ones(2990))
+    store.set(5000, 'A', 1)
+    column = store.columns['A']
+    assert column.next_change(0, 1) == 10
+    assert column.next_change(10, 1) == 3000
+    assert column.next_change(3000, 1) == 5000
+    assert column.next_change(5001, 1) is None
+    assert column.next_change(4000, -1) == 2999
+    assert column.next_change(100, -1) == 9
+    assert column.next_change(5, -1) is None
+    store.set(0, 'A', 1)
+    assert column.next_change(0, -1) == -1
+
+def test_next_change_in_row():
+    store = CellStore()
+    for col in ('B', 'C', 'D', 'G'):
+        store.set(3, col, 1)
+    assert store.next_change_in_row(3, 0, 1) == 1
+    assert store.next_change_in_row(3, 1, 1) == 4
+    assert store.next_change_in_row(3, 4, 1) == 6
+    assert store.next_change_in_row(3, 6, 1) == 7
+    assert store.next_change_in_row(3, 7, 1) is None
+    assert store.next_change_in_row(3, 5, -1) == 3
+    assert store.next_change_in_row(3, 3, -1) == 0
+    assert store.next_change_in_row(2, 3, -1) is None
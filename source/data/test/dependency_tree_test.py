@@ -0,0 +1,184 @@
+import numpy as np
+
+from ..dependency_tree import DependencyGraph
+from .formula_test import get_column_table
+
+def get_graph(links):
+    graph = DependencyGraph()
+    for cell, precedents in links.items():
+        graph.set_precedents(cell, precedents)
+    return graph
+
+def test_diamond_order():
+    graph = get_graph({(1, 'A'): [(0, 'A')], (2, 'A'): [(0, 'A')], (3, 'A'): [(1, 'A'), (2, 'A')]})
+    graph.mark_dirty((0, 'A'))
+    order = list(graph.recalculation_order())
+    assert order[0] == (0, 'A')
+    assert order[-1] == (3, 'A')
+    assert len(order) == 4
+    assert not graph.has_dirty()
+
+def test_deep_chain_is_iterative():
+    graph = get_graph({(i + 1, 'A'): [(i, 'A')] for i in range(50000)})
+    graph.mark_dirty((0, 'A'))
+    assert list(graph.recalculation_order()) == [(i, 'A') for i in range(50001)]
+
+def test_cycle_yields_once():
+    graph = get_graph({(0, 'A'): [(1, 'A'), (2, 'A')], (1, 'A'): [(0, 'A')]})
+    graph.mark_dirty((2, 'A'))
+    assert sorted(graph.recalculation_order()) == [(0, 'A'), (1, 'A'), (2, 'A')]
+
+def test_only_affected_cells():
+    graph = get_graph({(1, 'A'): [(0, 'A')], (2, 'A'): [(1, 'A')], (1, 'X'): [(0, 'X')]})
+    graph.mark_dirty((1, 'A'))
+    assert list(graph.recalculation_order()) == [(1, 'A'), (2, 'A')]
+
+def test_set_precedents_replaces_links():
+    graph = get_graph({(1, 'A'): [(0, 'A')]})
+    graph.set_precedents((1, 'A'), [(0, 'X')])
+    assert list(graph.get_dependents((0, 'A'))) == []
+    graph.remove((1, 'A'))
+    assert graph.dependents == {}
+
+def test_running_balance():
+    td = get_column_table([1.0] * 200)
+    td.set_value(0, 'B', 0.0)
+    f = td.make_formula(1, 'B', 'B0 + A1')
+    for r in range(2, 200):
+        td.add_formula(r, 'B', f.make_child((r, 'B')))
+    td.recalculate()
+    td.set_value(0, 'B', 10.0)
+    td.recalculate()
+    assert td.get_cell_value('B', 199) == 209
+
+def test_range_dependents():
+    graph = DependencyGraph()
+    for r in range(1, 1000):
+        graph.set_precedents((r, 'B'), [], [((0, r), (0, 0))])
+    assert len(graph.get_dependents((500, 'A'))) == 500
+    assert len(graph.get_dependents((0, 'A'))) == 999
+    assert len(graph.get_dependents((0, 'B'))) == 0
+    graph.remove((999, 'B'))
+    assert len(graph.get_dependents((500, 'A'))) == 499
+
+def test_range_formula_recalculates():
+    td = get_column_table([1.0] * 100)
+    f = td.make_formula(0, 'B', 'sum($A$0:A0)')
+    for r in range(1, 100):
+        td.add_formula(r, 'B', f.make_child((r, 'B')))
+    td.recalculate()
+    assert td.get_cell_value('B', 99) == 100
+    td.set_value(50, 'A', 11.0)
+    td.recalculate()
+    assert td.get_cell_value('B', 49) == 50
+    assert td.get_cell_value('B', 99) == 110
+
+def test_early_cutoff():
+    graph = get_graph({(1, 'A'): [(0, 'A')], (2, 'A'): [(1, 'A')], (1, 'B'): [(0, 'A')]})
+    graph.mark_dirty((0, 'A'))
+    evaluated = []
+    def evaluate(cell):
+        evaluated.append(cell)
+        return cell != (1, 'A')
+    graph.recalculate(evaluate)
+    assert sorted(evaluated) == [(0, 'A'), (1, 'A'), (1, 'B')]
+
+def test_unchanged_value_stops_propagation():
+    td = get_column_table([1.0, 2.0])
+    td.make_formula(0, 'B', 'A0 > 0')
+    td.make_formula(0, 'C', 'B0 * 1.0')
+    td.recalculate()
+    td._store_value(0, 'C', 'untouched')
+    td.set_value(0, 'A', 5.0)
+    td.recalculate()
+    assert td.get_cell_value('C', 0) == 'untouched'
+    td.set_value(0, 'A', -1.0)
+    td.recalculate()
+    assert td.get_cell_value('C', 0) == 0
+
+def test_formula_precedents():
+    td = get_column_table([1.0] * 10)
+    td.make_formula(0, 'B', 'A0 * 2')
+    td.make_formula(1, 'B', 'A1 * 2')
+    td.make_formula(0, 'C', 'sum(B0:B1)')
+    td.make_formula(0, 'D', 'C0 + 1')
+    td.make_formula(5, 'D', 'A5')
+    assert td.formula_precedents([(0, 'D')]) == {(0, 'D'), (0, 'C'), (0, 'B'), (1, 'B')}
+    td._store_value(0, 'D', 0)
+    td.recalculate_cells([(0, 'D')])
+    assert td.get_cell_value('D', 0) == 5
+
+def test_batch_recalculates_once():
+    td = get_column_table([1.0] * 10)
+    td.make_formula(0, 'B', 'sum(A0:A9)')
+    calls = []
+    recalculate = td.recalculate
+    td.recalculate = lambda: calls.append(1) or recalculate()
+    with td.batch():
+        for r in range(10):
+            td.set_value(r, 'A', 2.0)
+        assert td.get_cell_value('A', 3) == 2.0
+        assert td.get_cell_value('B', 0) == 10
+    assert calls == [1]
+    assert td.get_cell_value('B', 0) == 20
+
+def test_set_values_block():
+    td = get_column_table([1.0] * 4)
+    td.make_formula(0, 'D', 'sum(A0:C1)')
+    td.set_values(0, 'B', [[1, 2], [3, 4.5]])
+    assert td.get_cell_value('C', 1) == 4.5
+    assert td.get_cell_value('D', 0) == 12.5
+    td.set_values(0, 'C', [['x']])
+    assert td.get_cell_value('C', 0) == 'x'
+
+def test_fill_region_recalculates_after_batch_write():
+    td = get_column_table([1.0] * 100)
+    td.make_formula(0, 'B', 'A0 * 2')
+    td.fill(0, 'B', range(1, 100), ['B'])
+    td.set_values(0, 'A', [[5.0]] * 100)
+    assert td.get_cell_value('B', 50) == 10
+
+    td.make_formula(0, 'C', 'sum($B$0:B0)')
+    td.fill(0, 'C', range(1, 40), ['C'])
+    td.make_formula(0, 'D', 'C0 + B1')
+    td.fill(0, 'D', range(1, 40), ['D'])
+    td.set_value(5, 'A', 9.0)
+    td.recalculate()
+    values = [td.get_cell_value('D', r) for r in range(40)]
+    td.force_update()
+    assert values == [td.get_cell_value('D', r) for r in range(40)]
+
+def test_fill_region_is_one_node():
+    td = get_column_table([float(i) for i in range(100)])
+    td.make_formula(0, 'B', 'A0 * 2')
+    td.fill(0, 'B', range(1, 100), ['B'])
+    td.make_formula(0, 'C', 'sum(B0:B99)')
+    assert td.graph.precedents.keys() == {(0, 'C')}
+
+    td.graph.mark_dirty_rows('A', range(100))
+    order = td.graph.recalculation_order()
+    assert len(order) == 2 and order[1] == (0, 'C')
+
+    td.set_column('A', range(100), np.ones(100))
+    assert td.get_cell_value('B', 99) == 2
+    assert td.get_cell_value('C', 0) == 200
+
+def test_fill_region_split():
+    td = get_column_table([float(i) for i in range(100)])
+    td.make_formula(0, 'B', 'A0 * 2')
+    td.fill(0, 'B', range(1, 100), ['B'])
+    td.remove_formula(50, 'B')
+    td.make_formula(60, 'B', 'A60 + 1')
+    td.set_column('A', range(100), np.ones(100))
+    assert [td.get_cell_value('B', r) for r in (0, 49, 50, 59, 60, 61, 99)] == [2, 2, 100, 2, 2, 2, 2]
+
+def test_fill_region_on_cycle():
+    # E10 -> D50 -> E50 orders cell by cell, but not as a region
+    td = get_column_table(range(100), 'D')
+    td.make_formula(0, 'E', 'D0 * 2')
+    td.fill(0, 'E', range(1, 100), ['E'])
+    td.make_formula(50, 'D', 'E10')
+    td.set_value(10, 'D', 7)
+    td.recalculate()
+    assert td.get_cell_value('D', 50) == 14
+    assert td.get_cell_value('E', 50) == 28
@@ -2,7 +2,7 @@
 import pandas as pd
 
 from ..formula import Formula, colint, colval
-from ..table_data import TableData
+from ..table_data import TableData, MIN_FILL_REGION
 
 def test_colint():
     assert colint('A') == 0
@@ -49,5 +49,97 @@ def test_addition_formula():
     assert td.get_cell_value(1, "B") == 4
     assert td.get_cell_value(2, "C") == 10
 
+def get_column_table(values, col='A'):
+    td = TableData()
+    for row, value in enumerate(values):
+        td.set_value(row, col, value)
+    return td
 
+def test_overlapping_tokens():
+    td = get_column_table([float(i) for i in range(12)])
+    f = td.make_formula(1, 'B', 'A1 + A10 * 100')
+    assert f.get_value() == 1001
 
+def test_compiled_formula_shared():
+    td = get_column_table([float(i) for i in range(12)])
+    f = td.make_formula(1, 'B', 'A1 + sum($A$1:A3)')
+    child = f.make_child((4, 'B'))
+    assert child.root().compiled is f.compiled
+    assert child.get_display_formula() == 'A4 + sum($A$1:A6)'
+    assert child.get_value() == 4 + 21
+
+def test_child_formula_is_compact():
+    td = get_column_table([float(i) for i in range(12)])
+    f = td.make_formula(1, 'B', 'A1 * 2')
+    grandchild = f.make_child((2, 'B')).make_child((3, 'B'))
+    assert grandchild.root() is f
+    assert not hasattr(grandchild, '__dict__')
+    assert grandchild.get_value() == 6
+
+def test_fill_region_values():
+    td = get_column_table([float(i) for i in range(40)])
+    f = td.make_formula(0, 'B', 'A0 * 2 + $A$1')
+    for r in range(1, 40):
+        td.add_formula(r, 'B', f.make_child((r, 'B')))
+    regions = td.find_fill_regions([(r, 'B') for r in range(40)])
+    assert len(regions) == 1
+    assert list(regions[0].get_values()) == [r * 2 + 1 for r in range(40)]
+
+def test_fill_region_falls_back_on_error():
+    td = get_column_table([float(i) for i in range(40)])
+    f = td.make_formula(0, 'B', '1 / A0')
+    for r in range(1, 40):
+        td.add_formula(r, 'B', f.make_child((r, 'B')))
+    td.set_value(0, 'A', 0.0)
+    td.recalculate()
+    assert td.get_cell_value('B', 0).startswith('Formula Error')
+    assert td.get_cell_value('B', 4) == 0.25
+
+def test_fill_formula_and_value():
+    table = get_column_table(range(50))
+    table.make_formula(0, 'B', 'A0 * 2')
+    table.fill(0, 'B', range(1, 50), ['B'])
+    assert table.get_cell_value('B', 49) == 98
+    assert table.get_formula(49, 'B').root() is table.get_formula(0, 'B')
+
+    table.make_formula(0, 'C', 'B0 + 1')
+    table.fill(0, 'C', range(0, 1), ['D', 'E'])
+    assert table.get_formula(0, 'E').get_display_formula() == 'D0 + 1'
+    assert table.get_cell_value('E', 0) == 3
+
+    table.fill(0, 'A', range(1, 5), ['A', 'B'])
+    assert table.get_cell_value('A', 4) == 0
+    assert table.get_formula(4, 'B') is None
+    assert table.get_cell_value('B', 4) == 0
+    assert table.get_cell_value('B', 5) == 10
+
+def test_paste_block():
+    table = get_column_table(range(10))
+    table.make_formula(0, 'B', 'A0 + 1')
+    cells = {(0, 0) : table.get_formula(0, 'B'), (1, 0) : 'text', (0, 1) : 7}
+    table.paste(5, 'C', cells)
+    assert table.get_formula(5, 'C').get_display_formula() == 'B5 + 1'
+    assert table.get_cell_value('C', 6) == 'text'
+    assert table.get_cell_value('D', 5) == 7
+
+def test_fill_region_keeps_int_results():
+    results = []
+    for rows in (MIN_FILL_REGION - 1, MIN_FILL_REGION):
+        table = get_column_table(list(range(rows)))
+        table.make_formula(0, 'B', 'A0 * 2')
+        table.fill(0, 'B', range(1, rows), ['B'])
+        table.make_formula(0, 'C', 'A0 / 2')
+        table.fill(0, 'C', range(1, rows), ['C'])
+        results.append((table.get_cell_value('B', 3), table.get_cell_value('C', 3)))
+    assert results == [(6, 1.5), (6, 1.5)]
+    assert all(type(b) is int and type(c) is float for b, c in results)
+
+def test_fill_region_int_error_matches_cells():
+    results = []
+    for rows in (MIN_FILL_REGION - 1, MIN_FILL_REGION):
+        table = get_column_table(list(range(-2, rows - 2)))
+        table.make_formula(0, 'B', '2 ** A0')
+        table.fill(0, 'B', range(1, rows), ['B'])
+        results.append([table.get_cell_value('B', r) for r in range(rows - 1)])
+    assert results[0] == results[1][:len(results[0])]
+    assert [type(v) for v in results[0]] == [type(v) for v in results[1][:len(results[0])]]
@@ -0,0 +1,125 @@
+import os
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from .. import journal
+from ..table_data import TableData
+from ..journal import journal_path
+
+
+def saved_table(path):
+    td = TableData()
+    td.set_value(0, 'A', 1)
+    td.set_value(1, 'A', 2)
+    td.set_filename(path)
+    td.save()
+    return td
+
+
+def test_journal_replays_edits(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    td = saved_table(path)
+    td.set_value(0, 'A', 5)
+    base = td.make_formula(0, 'B', 'A0 + A1')
+    td.add_formula(1, 'B', base.make_child((1, 'B')))
+    td.make_formula(0, 'C', 'A0 * 10')
+    td.remove_formula(0, 'C')
+    td.set_value(0, 'C', 'text')
+    td.sync_journal()
+
+    loaded = TableData()
+    loaded.load_file(path)
+    assert loaded.get_cell_value('A', 0) == 5
+    assert loaded.get_cell_value('B', 0) == 7
+    assert loaded.get_formula(1, 'B').get_display_formula() == 'A1 + A2'
+    assert loaded.get_formula(0, 'C') is None
+    assert loaded.get_cell_value('C', 0) == 'text'
+
+
+def test_journal_written_only_for_edits(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    td = saved_table(path)
+    assert not os.path.exists(journal_path(path))
+    loaded = TableData()
+    loaded.load_file(path)
+    loaded.sync_journal()
+    assert not os.path.exists(journal_path(path))
+    td.set_value(0, 'A', 5)
+    td.sync_journal()
+    assert os.path.exists(journal_path(path))
+    td.save()
+    assert not os.path.exists(journal_path(path))
+
+
+def test_unwritable_journal_is_turned_off(tmp_path, monkeypatch):
+    path = str(tmp_path / 'sheet.dc')
+    saved_table(path)
+
+    def refuse(self):
+        raise PermissionError('read only')
+    monkeypatch.setattr(journal.Journal, '_open_file', refuse)
+    td = TableData()
+    td.load_file(path)
+    td.set_value(0, 'A', 5)
+    td.sync_journal()
+    assert td.journal is None
+    assert 'read only' in td.journal_error
+    assert td.get_cell_value('A', 0) == 5
+
+
+def test_journal_for_other_file_is_ignored(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    td = saved_table(path)
+    td.set_value(0, 'A', 5)
+    td.sync_journal()
+    # The file changed without going through this table
+    with open(path, 'a') as f:
+        f.write(' ')
+    with open(journal_path(path), 'a') as f:
+        f.write('["v", "A0"')
+
+    loaded = TableData()
+    loaded.load_file(path)
+    assert loaded.get_cell_value('A', 0) == 1
+
+
+def test_fill_is_one_record(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    td = saved_table(path)
+    td.make_formula(0, 'B', 'A0 * 3')
+    td.fill(0, 'B', range(1, 2), ['B'])
+    td.fill(1, 'A', range(2, 100), ['A'])
+    td.sync_journal()
+    with open(journal_path(path)) as f:
+        assert len(f.readlines()) == 4
+
+    loaded = TableData()
+    loaded.load_file(path)
+    assert loaded.get_cell_value('B', 1) == 6
+    assert loaded.get_cell_value('A', 99) == 2
+
+
+def test_block_writes_are_one_record_per_column(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    td = saved_table(path)
+    index = pd.date_range('2024-01-01', periods=500, freq='D', name='Date')
+    frame = pd.DataFrame({'Close' : np.arange(500) * 1.5, 'Volume' : np.arange(500)}, index=index)
+    td.place_dataframe(5, 'B', frame)
+    td.set_values(2, 'F', [[1, 'x'], [None, 2.5]])
+    td.sync_journal()
+    with open(journal_path(path)) as f:
+        # Header values, one record per frame column, one per set_values column
+        assert len(f.readlines()) == 1 + 2 + 3 + 2
+
+    loaded = TableData()
+    loaded.load_file(path)
+    for row in (6, 505):
+        for col in 'BCD':
+            assert loaded.get_cell_value(col, row) == td.get_cell_value(col, row)
+    assert isinstance(loaded.get_cell_value('B', 6), datetime.datetime)
+    assert type(loaded.get_cell_value('D', 7)) is int
+    assert loaded.get_cell_value('G', 2) == 'x'
+    assert loaded.get_cell_value('G', 3) == 2.5
@@ -0,0 +1,63 @@
+import numpy as np
+
+from .. import memo
+from ..cell_range import CellRange
+from ..memo import cache, pure
+
+
+def test_pure_hits_on_equal_arguments():
+    calls = []
+
+    @pure
+    def total(values, scale=1):
+        calls.append(1)
+        if isinstance(values, CellRange):
+            values = values.values
+        return float(np.sum(values)) * scale
+
+    a = np.arange(1000, dtype=float)
+    assert total(a) == total(a.copy())
+    assert total(CellRange(a.reshape(-1, 1))) == total(CellRange(a.reshape(-1, 1).copy()))
+    assert len(calls) == 2
+    total(a, scale=2)
+    b = a.copy()
+    b[5] = -1
+    total(b)
+    assert len(calls) == 4
+    info = total.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 4, 4)
+    total.cache_clear()
+    assert total.cache_info().currsize == 0
+
+
+def test_lru_and_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(memo.time, 'monotonic', lambda: now[0])
+
+    @cache(maxsize=2, ttl=10)
+    def double(x):
+        return [x * 2]
+
+    double(1)
+    double(2)
+    double(1)
+    double(3)
+    # 2 was least recently used
+    assert double.cache_info().currsize == 2
+    double(2)
+    assert double.cache_info().misses == 4
+
+    now[0] = 11
+    double(2)
+    assert double.cache_info().misses == 5
+
+
+def test_unhashable_arguments_run_uncached():
+    @pure
+    def size(x):
+        return len(x)
+
+    assert size({1, 2}) == 2
+    assert size({1, 2}) == 2
+    assert size.cache_info().uncached == 2
+    assert 'size' in memo.report()
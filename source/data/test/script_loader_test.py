@@ -0,0 +1,65 @@
+import os
+import sys
+
+from .. import script_loader
+from ..script_loader import ScriptLoader, scan_names
+from ..table_data import TableData
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def test_scan_names():
+    source = 'import os\nimport numpy as np\nfrom math import sqrt, pi as PI\n' \
+             'X = 1\na, b = 2, 3\ndef double(x):\n    y = 2\n    return x * y\nclass Thing:\n    pass\n'
+    assert scan_names(source) == {'os', 'np', 'sqrt', 'PI', 'X', 'a', 'b', 'double', 'Thing'}
+    assert scan_names('from math import *\n') is None
+    assert scan_names('try:\n    import numpy\nexcept ImportError:\n    pass\n') is None
+
+
+def test_scripts_import_on_first_use(tmp_path, monkeypatch):
+    write(tmp_path / 'helpers.py', 'def double(x):\n    return x * 2\n')
+    write(tmp_path / 'other.py', 'def triple(x):\n    return x * 3\n')
+    write(tmp_path / 'starred.py', 'from math import *\n')
+    write(tmp_path / 'notes.txt', 'not python')
+    monkeypatch.setenv('DECEL_SCRIPT_DIR', str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+
+    loader = ScriptLoader()
+    assert [f.split('/')[-1] for f in loader.modules] == ['starred.py']
+    assert {'double', 'triple'} <= loader.names()
+
+    script_vars = loader.get_vars()
+    assert script_vars['double'](4) == 8
+    assert script_vars['sqrt'](16) == 4
+    assert sorted(f.split('/')[-1] for f in loader.modules) == ['helpers.py', 'starred.py']
+    assert (tmp_path / '__pycache__').is_dir()
+    assert 'Scripts: 2 of 3 imported' in loader.report()
+
+
+def test_poll_reloads_changed_scripts(tmp_path, monkeypatch):
+    write(tmp_path / 'pricing.py', 'def price(x):\n    return x * 2\n')
+    write(tmp_path / 'other.py', 'def other(x):\n    return x + 1\n')
+    monkeypatch.setenv('DECEL_SCRIPT_DIR', str(tmp_path))
+    loader = ScriptLoader()
+    monkeypatch.setattr(script_loader, '_decel_script_loader', loader)
+
+    td = TableData()
+    td.set_value(0, 'A', 10)
+    td.make_formula(0, 'B', 'price(A0)')
+    td.make_formula(0, 'C', 'other(A0)')
+    td.make_formula(0, 'D', 'A0 + 1')
+    td.recalculate()
+    assert td.get_cell_value('B', 0) == 20
+    assert loader.poll(interval=0) == set()
+
+    write(tmp_path / 'pricing.py', 'def price(x):\n    return x * 3\n')
+    os.utime(tmp_path / 'pricing.py', ns=(0, 10 ** 9))
+    assert td.reload_scripts() == set() # checked less than a second ago
+    loader.last_poll = 0
+    assert td.reload_scripts() == {'price'}
+    assert td.graph.dirty == {(0, 'B')}
+    td.recalculate()
+    assert td.get_cell_value('B', 0) == 30
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import stocks, table_data, tick_cache
+from ..stocks import tick, set_fetcher, StockException
+from ..tick_cache import TickCache, read_frame, write_frame
+from ..table_data import TableData
+
+
+def bars(ticker, rows=5):
+    index = pd.date_range('2024-01-02 09:30', periods=rows, freq='h', tz='America/New_York', name='Datetime')
+    close = np.arange(rows, dtype=float) + len(ticker)
+    return pd.DataFrame({'Close' : close, 'Volume' : np.arange(rows, dtype=np.int64) * 100}, index=index)
+
+
+@pytest.fixture
+def fetched(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_fetch(tickers, period, interval):
+        calls.append((list(tickers), period, interval))
+        return {t : bars(t) for t in tickers if t != 'NONE'}
+
+    monkeypatch.setattr(stocks, '_tick_cache', TickCache(str(tmp_path), ttl=60))
+    monkeypatch.delenv('DECEL_TICK_OFFLINE', raising=False)
+    previous = set_fetcher(fake_fetch)
+    yield calls
+    set_fetcher(previous)
+
+
+def test_frame_round_trip(tmp_path):
+    frame = bars('AAPL')
+    path = str(tmp_path / 'aapl.npz')
+    write_frame(path, frame)
+    loaded = read_frame(path)
+    pd.testing.assert_frame_equal(loaded, frame, check_freq=False)
+
+
+def test_tick_reuses_cache(fetched, tmp_path):
+    first = tick('aapl')
+    assert tick('AAPL', '3mo', '1h') is first
+    assert fetched == [(['AAPL'], '3mo', '1h')]
+    tick('AAPL', p='1y')
+    assert len(fetched) == 2
+
+    # A new session reads the files instead of downloading again
+    stocks._tick_cache = TickCache(str(tmp_path), ttl=60)
+    pd.testing.assert_frame_equal(tick('AAPL'), first, check_freq=False)
+    assert len(fetched) == 2
+
+
+def test_stale_and_offline(fetched, monkeypatch):
+    tick('MSFT')
+    now = tick_cache.time.time()
+    monkeypatch.setattr(tick_cache.time, 'time', lambda: now + 120)
+    tick('MSFT')
+    assert len(fetched) == 2
+
+    monkeypatch.setattr(tick_cache.time, 'time', lambda: now + 240)
+    monkeypatch.setenv('DECEL_TICK_OFFLINE', '1')
+    assert tick('MSFT') is not None
+    assert len(fetched) == 2
+    with pytest.raises(StockException):
+        tick('GOOG')
+    monkeypatch.delenv('DECEL_TICK_OFFLINE')
+    with pytest.raises(StockException):
+        tick('NONE')
+
+
+def test_recalculation_batches_downloads(fetched):
+    td = TableData()
+    tickers = ['AAPL', 'MSFT', 'GOOG', 'IBM']
+    with td.batch():
+        for row, ticker in enumerate(tickers, 1):
+            td.set_value(row, 'A', ticker)
+            td.make_formula(row, 'B', "tick(A{})['Close'].iloc[-1]".format(row))
+        td.make_formula(5, 'B', "tick(A1, '1y')['Close'].iloc[-1]")
+    assert sorted(fetched) == [(['AAPL'], '1y', '1h'), (tickers, '3mo', '1h')]
+    assert td.get_cell_value('B', 2) == bars('MSFT')['Close'].iloc[-1]
+
+    # Fresh data isn't downloaded again
+    td.force_update()
+    assert len(fetched) == 2
+
+
+def test_prefetch_only_evaluates_tick_arguments(fetched, monkeypatch):
+    calls = []
+
+    def expensive(x):
+        calls.append(x)
+        return 1
+    monkeypatch.setitem(table_data.defaults, 'expensive', expensive)
+    td = TableData()
+    with td.batch():
+        for row, ticker in enumerate(['AAPL', 'MSFT'], 1):
+            td.set_value(row, 'A', ticker)
+            td.make_formula(row, 'B', "expensive(A{0}) + tick(ticker=A{0})['Close'].iloc[-1]".format(row))
+    assert fetched == [(['AAPL', 'MSFT'], '3mo', '1h')]
+    assert sorted(calls) == ['AAPL', 'MSFT']
+
+
+def test_cache_files_stay_in_cache_dir(fetched, tmp_path):
+    tick('X/Y', '../../elsewhere', '../1h')
+    assert [p.parent for p in tmp_path.rglob('*.npz')] == [tmp_path]
+    assert not (tmp_path.parent / 'elsewhere').exists()
@@ -0,0 +1,146 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from .. import table_data
+from ..table_data import TableData, encode_cells, decode_cells
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+def test_load_csv_classifies_cells(tmp_path):
+    path = write(tmp_path / 'sheet.csv', '1,hello world,A0 + 1\n2.5,sum,"(1 + 2)"\n,x,\n')
+    td = TableData()
+    td.load_csv(path)
+    assert td.get_cell_value('A', 0) == 1
+    assert td.get_cell_value('A', 1) == 2.5
+    assert td.get_cell_value('A', 2) is None
+    assert td.get_cell_value('B', 0) == 'hello world'
+    assert td.get_cell_value('B', 1) is sum
+    assert td.get_cell_value('C', 0) == 2
+    assert td.get_formula(0, 'C') is not None
+    assert td.get_cell_value('C', 1) == 3
+
+def test_iter_load_csv_reads_in_chunks(tmp_path):
+    path = write(tmp_path / 'sheet.csv', 'A3 * 2,1\nx,2\n7,3\n8,4\n')
+    td = TableData()
+    progress = list(td.iter_load_csv(path, first_chunk=1, chunk_size=2))
+    assert [rows for rows, _ in progress] == [1, 3, 4]
+    assert progress[-1][1] == 1
+    # A0 was evaluated before row 3 was read
+    assert td.get_cell_value('A', 0) == 16
+    assert td.get_cell_value('B', 3) == 4
+    assert td.filename() == path
+
+def test_encode_cells_as_ranges():
+    cells = [(r, 'B') for r in range(2, 100)] + [(r, 'C') for r in range(2, 100)]
+    cells += [(4, 'D'), (7, 'D')]
+    text = encode_cells(cells)
+    assert text == 'B2:C99,D4,D7'
+    assert sorted(decode_cells(text)) == sorted(cells)
+    assert list(decode_cells('A1,B2')) == [(1, 'A'), (2, 'B')]
+
+def test_dc_round_trip_with_filled_column(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    td = TableData()
+    with td.batch():
+        for r in range(100):
+            td.set_value(r, 'A', r)
+        base = td.make_formula(0, 'B', 'A0 * 2')
+        for r in range(1, 100):
+            td.add_formula(r, 'B', base.make_child((r, 'B')))
+    td.set_filename(path)
+    td.save()
+    assert td.get_formula_jsondata()['B0']['children'] == 'B0:B99'
+
+    loaded = TableData()
+    loaded.load_file(path)
+    assert loaded.get_cell_value('B', 99) == 198
+    assert loaded.get_formula(50, 'B').get_display_formula() == 'A50 * 2'
+    assert not (tmp_path / 'tmp_csv.csv').exists()
+
+def save_with_cached_value(path, formula, value):
+    '''
+        Saves A0 = 2 and B0 = formula, with B0's saved value replaced
+    '''
+    td = TableData()
+    td.set_value(0, 'A', 2)
+    td.make_formula(0, 'B', formula)
+    td.save_dc(path)
+    with open(path) as f:
+        content = json.load(f)
+    content['decel']['csv'] = '2,{}\n'.format(value)
+    with open(path, 'w') as f:
+        json.dump(content, f)
+    return content
+
+def test_load_dc_keeps_saved_results(tmp_path):
+    path = str(tmp_path / 'sheet.dc')
+    save_with_cached_value(path, 'A0 * 2', 99)
+    td = TableData()
+    td.load_dc(path)
+    assert td.get_cell_value('B', 0) == 99
+    td.set_value(0, 'A', 3)
+    td.recalculate()
+    assert td.get_cell_value('B', 0) == 6
+
+def test_load_dc_recalculates_stale_results(tmp_path, monkeypatch):
+    path = str(tmp_path / 'sheet.dc')
+    content = save_with_cached_value(path, 'A0 * 2', 99)
+    content['decel']['stamp'] = {'scripts' : [['old.py', 0]]}
+    with open(path, 'w') as f:
+        json.dump(content, f)
+    td = TableData()
+    td.load_dc(path)
+    assert td.get_cell_value('B', 0) == 4
+
+    monkeypatch.setattr(table_data, 'volatile_functions', {'abs'})
+    save_with_cached_value(path, 'abs(A0)', 99)
+    td.load_dc(path)
+    assert td.get_cell_value('B', 0) == 2
+
+def test_used_range_and_next_occupied():
+    td = TableData()
+    assert td.used_range() is None
+    td.set_value(2, 'B', 1)
+    td.set_value(700000, 'B', 1)
+    td.set_value(5, 'E', 'x')
+    assert td.used_range() == ((2, 700000), (1, 4))
+    assert td.last_row() == 700000
+    assert td.last_col() == 4
+    assert td.next_occupied(2, 1, True, True) == (700000, 1)
+    assert td.next_occupied(700000, 1, True, False) == (2, 1)
+    assert td.next_occupied(5, 0, False, True) == (5, 4)
+    assert td.next_occupied(5, 4, False, True) is None
+
+def test_place_dataframe():
+    td = TableData()
+    td.make_formula(0, 'F', 'sum($C$2:C4)')
+    index = pd.date_range('2024-01-01', periods=3, freq='D')
+    frame = pd.DataFrame({'Open' : [1.5, 2.5, 3.5], 'Volume' : [10, 20, 30]}, index=index)
+    td.place_dataframe(1, 'B', frame)
+    assert td.get_cell_value('B', 1) is None
+    assert td.get_cell_value('C', 1) == 'Open'
+    assert td.get_cell_value('D', 1) == 'Volume'
+    assert td.get_cell_value('B', 2) == index[0]
+    assert td.get_cell_value('C', 4) == 3.5
+    assert td.get_cell_value('D', 2) == 10
+    assert type(td.get_cell_value('D', 2)) is int
+    assert td.get_cell_value('F', 0) == 7.5
+
+    td.place_dataframe(10, 'A', pd.DataFrame({'x' : ['a', 'b']}))
+    assert [td.get_cell_value('A', r) for r in (10, 11, 12)] == ['x', 'a', 'b']
+
+def test_place_dataframe_datetime_column():
+    td = TableData()
+    frame = pd.DataFrame({'when' : pd.to_datetime(['2024-01-01', None]), 'n' : [1, 2]})
+    td.place_dataframe(0, 'A', frame)
+    assert td.get_cell_value('A', 1) == pd.Timestamp('2024-01-01')
+    assert isinstance(td.get_cell_value('A', 1), pd.Timestamp)
+    assert td.get_cell_value('A', 2) is None
+
+    td.set_column('C', [0, 1], np.array(['2024-01-02', '2024-01-03'], dtype='M8[ns]'))
+    assert td.get_cell_value('C', 1) == pd.Timestamp('2024-01-03')
@@ -0,0 +1,53 @@
+import numpy as np
+
+from ..table_data import TableData
+from ..workbook import read_workbook, is_workbook
+
+
+def make_table():
+    td = TableData()
+    td.set_value(0, 'A', 3)
+    td.set_value(1, 'A', 4.5)
+    td.set_value(5000, 'A', 7)
+    td.set_value(0, 'B', 'text')
+    td.set_value(2, 'B', 2)
+    td.make_formula(0, 'C', 'A0 + A1')
+    return td
+
+
+def test_workbook_round_trip(tmp_path):
+    path = str(tmp_path / 'book.dcb')
+    td = make_table()
+    td.set_filename(path)
+    td.save()
+    assert is_workbook(path)
+
+    loaded = TableData()
+    loaded.load_file(path)
+    assert loaded.get_cell_value('A', 0) == 3
+    assert loaded.get_cell_value('A', 1) == 4.5
+    assert loaded.get_cell_value('A', 2) is None
+    assert loaded.get_cell_value('A', 5000) == 7
+    assert loaded.get_cell_value('B', 0) == 'text'
+    assert loaded.get_cell_value('B', 2) == 2
+    assert loaded.get_cell_value('C', 0) == 7.5
+    assert loaded.get_formula(0, 'C').get_display_formula() == 'A0 + A1'
+
+
+def test_workbook_columns_are_mapped(tmp_path):
+    path = str(tmp_path / 'book.dcb')
+    td = make_table()
+    td.save_dcb(path)
+
+    store, _, _ = read_workbook(path)
+    chunk = store.columns['A'].chunks[0]
+    assert isinstance(chunk.values, np.memmap)
+
+    # Edits stay in memory, and saving over the mapped file is safe
+    loaded = TableData()
+    loaded.load_dcb(path)
+    loaded.set_value(0, 'A', 10)
+    loaded.recalculate()
+    loaded.save_dcb(path)
+    assert loaded.get_cell_value('C', 0) == 14.5
+    assert read_workbook(path)[0].get(0, 'A') == 10
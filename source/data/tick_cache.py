@@ -0,0 +1,107 @@
+import os
+import time
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+'''
+    Disk cache for downloaded price history
+
+    Each (ticker, period, interval) is one .npz file: the index as int64
+    nanoseconds (UTC, with its time zone alongside) and every column as its
+    own array, so nothing is pickled and dtypes come back unchanged.
+
+    A file older than the ttl is stale. tick() fetches it again when
+    online, but still uses it when offline or when the fetch fails.
+'''
+
+# Seconds downloaded bars stay fresh
+DEFAULT_TTL = 15 * 60
+
+
+def cache_filename(key):
+    '''
+        Every part comes from formula text, so all of them are escaped to
+        keep the file inside the cache directory
+    '''
+    return '{}_{}_{}.npz'.format(*(quote(str(part), safe='') for part in key))
+
+
+def write_frame(path, frame):
+    '''
+        Written to a temporary file and moved into place, so a reader never
+        sees half a file
+    '''
+    index = pd.DatetimeIndex(frame.index)
+    arrays = {
+            'index' : index.asi8,
+            'tz' : np.array(str(index.tz) if index.tz is not None else ''),
+            'name' : np.array(index.name or ''),
+            'columns' : np.array([str(c) for c in frame.columns]),
+            }
+    for i, col in enumerate(frame.columns):
+        values = frame[col].to_numpy()
+        if values.dtype.kind == 'O':
+            values = values.astype(str)
+        arrays['c{}'.format(i)] = values
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_frame(path):
+    with np.load(path, allow_pickle=False) as data:
+        tz = str(data['tz'])
+        if tz:
+            index = pd.to_datetime(data['index'], utc=True).tz_convert(tz)
+        else:
+            index = pd.to_datetime(data['index'])
+        index.name = str(data['name']) or None
+        columns = [str(c) for c in data['columns']]
+        values = {col : data['c{}'.format(i)] for i, col in enumerate(columns)}
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+class TickCache:
+    '''
+        path - directory holding the files
+        ttl - seconds before a download is stale
+
+        Frames read or stored are also kept in memory, so recalculating a
+        sheet hands every tick() cell the same frame without touching disk.
+    '''
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.frames = {}
+
+    def _file(self, key):
+        return os.path.join(self.path, cache_filename(key))
+
+    def get(self, key, stale=False):
+        '''
+            Cached frame for key, or None if there isn't one or it is older
+            than the ttl (unless stale)
+        '''
+        now = time.time()
+        entry = self.frames.get(key)
+        if entry is None:
+            path = self._file(key)
+            try:
+                fetched = os.stat(path).st_mtime
+            except FileNotFoundError:
+                return None
+            entry = (fetched, read_frame(path))
+            self.frames[key] = entry
+        fetched, frame = entry
+        if not stale and now - fetched > self.ttl:
+            return None
+        return frame
+
+    def put(self, key, frame):
+        self.frames[key] = (time.time(), frame)
+        os.makedirs(self.path, exist_ok=True)
+        write_frame(self._file(key), frame)
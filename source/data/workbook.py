@@ -0,0 +1,203 @@
+import json
+import os
+
+import numpy as np
+
+from .cell_store import CellStore, Column, Chunk, CHUNK_SIZE, INT, FLOAT, OBJECT
+
+'''
+    Binary workbook format (.dcb)
+
+        magic       8 bytes, MAGIC
+        length      uint64, little endian, size of the header
+        header      JSON, utf-8
+        blocks      raw arrays, each starting on an ALIGN byte boundary
+
+    The header indexes every block:
+
+        {
+          "version" : 1,
+          "columns" : [
+            { "name" : "A",
+              "blocks" : [
+                { "kind" : "f", "chunks" : [0, 1, 5],
+                  "values" : offset, "valid" : offset },
+                ...
+              ] },
+            ...
+          ],
+          "formulae" : same table as the .dc format,
+          "stamp" : scripts the cached formula values were computed with
+        }
+
+    A block holds every chunk of one column that has the same kind, one
+    after another: CHUNK_SIZE values per chunk, then CHUNK_SIZE validity
+    flags per chunk. Numeric blocks are memory-mapped on open, so only the
+    pages that are read come off disk. Object blocks hold the valid values
+    as a JSON list instead of an array.
+'''
+
+MAGIC = b'DECELWB\x01'
+VERSION = 1
+ALIGN = 64
+
+_file_dtypes = {
+        INT : np.dtype('<i8'),
+        FLOAT : np.dtype('<f8'),
+        }
+_valid_dtype = np.dtype('|b1')
+
+
+class WorkbookException(Exception):
+    pass
+
+
+def json_value(value):
+    if isinstance(value, (str, bool, int, float)) or value is None:
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _pad(f):
+    extra = f.tell() % ALIGN
+    if extra:
+        f.write(b'\0' * (ALIGN - extra))
+
+
+def _column_blocks(column):
+    '''
+        (kind, [chunk indices]) for one column, in chunk order
+    '''
+    by_kind = {}
+    for index in sorted(column.chunks):
+        by_kind.setdefault(column.chunks[index].kind, []).append(index)
+    return list(by_kind.items())
+
+
+def _layout(store):
+    '''
+        Header entries for every column, with offsets relative to the start
+        of the data section
+    '''
+    columns = []
+    offset = 0
+    for name in store.columns:
+        column = store.columns[name]
+        blocks = []
+        for kind, indices in _column_blocks(column):
+            block = {'kind' : kind, 'chunks' : indices}
+            if kind == OBJECT:
+                values = []
+                for index in indices:
+                    chunk = column.chunks[index]
+                    values.extend(json_value(v) for v in chunk.values[chunk.valid])
+                data = json.dumps(values).encode('utf-8')
+                block['length'] = len(data)
+                block['data'] = data
+                size = len(data)
+            else:
+                size = len(indices) * CHUNK_SIZE * _file_dtypes[kind].itemsize
+            block['values'] = offset
+            offset += -(-size // ALIGN) * ALIGN
+            block['valid'] = offset
+            offset += -(-len(indices) * CHUNK_SIZE // ALIGN) * ALIGN
+            blocks.append(block)
+        columns.append({'name' : name, 'blocks' : blocks})
+    return columns
+
+
+def write_workbook(filepath, store, formulae, stamp=None):
+    '''
+        store - CellStore
+        formulae - formula table, see TableData.get_formula_jsondata
+        stamp - see TableData.calc_stamp
+
+        Written to a temporary file and moved into place, so a workbook
+        that is currently mapped is never truncated underneath its reader
+    '''
+    columns = _layout(store)
+    header = {'version' : VERSION, 'formulae' : formulae, 'stamp' : stamp, 'columns' : [
+        {'name' : c['name'], 'blocks' : [
+            {k : v for k, v in b.items() if k != 'data'} for b in c['blocks']]}
+        for c in columns]}
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    tmp_path = filepath + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        _pad(f)
+        data_start = f.tell()
+        for entry in columns:
+            column = store.columns[entry['name']]
+            for block in entry['blocks']:
+                f.seek(data_start + block['values'])
+                chunks = [column.chunks[i] for i in block['chunks']]
+                if block['kind'] == OBJECT:
+                    f.write(block['data'])
+                else:
+                    dtype = _file_dtypes[block['kind']]
+                    for chunk in chunks:
+                        f.write(chunk.values.astype(dtype, copy=False).tobytes())
+                f.seek(data_start + block['valid'])
+                for chunk in chunks:
+                    f.write(chunk.valid.astype(_valid_dtype, copy=False).tobytes())
+        _pad(f)
+    os.replace(tmp_path, filepath)
+
+
+def is_workbook(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(filepath):
+    '''
+        Returns (header, offset of the data section)
+    '''
+    with open(filepath, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise WorkbookException('Not a decel workbook: {}'.format(filepath))
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header.get('version') != VERSION:
+        raise WorkbookException('Unsupported workbook version: {}'.format(header.get('version')))
+    data_start = len(MAGIC) + 8 + length
+    data_start += -data_start % ALIGN
+    return header, data_start
+
+
+def _map(filepath, dtype, offset, count):
+    # Copy on write: edits stay in memory and never reach the file
+    return np.memmap(filepath, dtype=dtype, mode='c', offset=offset, shape=(count,))
+
+
+def read_workbook(filepath):
+    '''
+        Returns (CellStore, formula table, stamp)
+    '''
+    header, data_start = read_header(filepath)
+    store = CellStore()
+    for entry in header['columns']:
+        column = Column()
+        for block in entry['blocks']:
+            indices = block['chunks']
+            count = len(indices) * CHUNK_SIZE
+            valid = _map(filepath, _valid_dtype, data_start + block['valid'], count)
+            if block['kind'] == OBJECT:
+                with open(filepath, 'rb') as f:
+                    f.seek(data_start + block['values'])
+                    values = json.loads(f.read(block['length']).decode('utf-8'))
+                flat = np.full(count, None, dtype=object)
+                flat[np.asarray(valid)] = values
+                valid = np.array(valid)
+            else:
+                flat = _map(filepath, _file_dtypes[block['kind']], data_start + block['values'], count)
+            for i, index in enumerate(indices):
+                part = slice(i * CHUNK_SIZE, (i + 1) * CHUNK_SIZE)
+                column.chunks[index] = Chunk.from_arrays(flat[part], valid[part])
+        store.columns[entry['name']] = column
+    return store, header['formulae'], header.get('stamp')
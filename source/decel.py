@@ -0,0 +1,13 @@
+'''
+    Helpers for scripts in DECEL_SCRIPT_DIR
+
+        import decel
+
+        @decel.cache(maxsize=256, ttl=60)
+        def fit(xs, ys):
+            ...
+
+    See data/memo.py
+'''
+
+from data.memo import cache, pure, report
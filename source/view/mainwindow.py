@@ -8,6 +8,8 @@ from .sheet_window import SheetWindow
 from data.table_data import TableData
 from configfile import DecelConfig
 
+IDLE_TIMEOUT_MS = 1000
+
 class MainWindow(Window):
 
     def __init__(self, args):
@@ -76,7 +78,17 @@ class MainWindow(Window):
             self.refresh(self.stdscr)
             self.stdscr.refresh()
             self.stdscr.move(*self.cursor)
+            # Keep reading a file being opened between keypresses, and
+            # otherwise wake up now and then to look for changed scripts
+            loading = self.sheet.is_loading()
+            self.stdscr.timeout(0 if loading else IDLE_TIMEOUT_MS)
             ch = self.stdscr.getch()
+            if ch == -1:
+                if loading:
+                    self.sheet.continue_loading()
+                else:
+                    self.sheet.check_scripts()
+                continue
             if ch == curses.KEY_RESIZE:
                 continue
             else:
@@ -8,7 +8,9 @@ from .utils.input import BasicInput
 from .utils.general import fix_text_to_width, align_text, min_max, iterate_range_2d
 from .window import Window
 from data.table_data import TableData
-from data.formula import colint, colval, has_tokens, Formula
+from data.formula import colint, colval, has_tokens
+from data.script_loader import get_loader
+from data import memo
 from .popup import Popup, InputPopup
 from .utils.keys import *
 
@@ -96,7 +98,8 @@ class SheetWindow(Window):
 
         self.input = BasicInput(on_confirm=self.confirm_input, on_cancel=self.cancel_input)
         self.tmp_message = ''
-
+        self.loading = None
+        self.load_progress = ''
 
         self.current_input_type = SheetWindow.I_TYPE_DISPLAY
         self.entry_color = self.colors.get_color_id("Black", "Green")
@@ -117,11 +120,46 @@ class SheetWindow(Window):
         self.wait_for_key = False
 
     def load_file(self, filename):
+        if filename.endswith('.csv'):
+            self.loading = self.table.iter_load_csv(filename)
+            self.continue_loading()
+            return
         self.table.load_file(filename)
 
+    def is_loading(self):
+        return self.loading is not None
+
+    def continue_loading(self):
+        '''
+            Reads the next chunk of a file being opened
+        '''
+        try:
+            rows, fraction = next(self.loading)
+        except StopIteration:
+            self.loading = None
+            self.load_progress = ''
+            self.set_tmp_message('Loaded file: {}'.format(self.table.filename()))
+        else:
+            self.load_progress = 'Loading: {:.0%} ({} rows)'.format(fraction, rows)
+        self.draw_page()
+
+    def check_scripts(self):
+        '''
+            Called while idle, recalculates formulas using scripts that
+            changed on disk
+        '''
+        if self.table.reload_scripts():
+            self.set_tmp_message('Reloaded scripts')
+            self.draw_page()
+
     def force_refresh(self):
         self.table.force_update()
 
+    def refresh_selection(self):
+        cells = [(r, colval(c)) for r, c in iterate_range_2d(self.select_anchor, self.cursor)]
+        self.table.recalculate_cells(cells)
+        self.end_select()
+
     def load_config(self, config):
         self.default_col_width = config.default_column_width()
         self.row_jump_size = config.row_jump_size()
@@ -238,7 +276,11 @@ class SheetWindow(Window):
         return (r, colval(c))
 
     def draw_page(self):
-        self.table.trigger_update()
+        self.table.recalculate()
+        self.table.sync_journal()
+        if self.table.journal_error:
+            self.set_tmp_message(self.table.journal_error)
+            self.table.journal_error = None
         self.draw_sheet()
         self.draw_entry()
 
@@ -328,6 +370,8 @@ class SheetWindow(Window):
         if tmp:
             self.set_tmp_message('')
             return tmp
+        if self.load_progress:
+            return self.load_progress
         r, c = self.cursor
         row, col = (r, colval(c))
         formula = self.table.get_formula(row, col)
@@ -398,45 +442,26 @@ class SheetWindow(Window):
         else:
             self._move_cursor_inner(rchange, cchange)
 
-    def _find_until(self, start, vertical, positive, radius=2, max_iter=1000):
+    def _find_until(self, start, vertical, positive, radius=2):
+        '''
+            Moves from start until any cell in a band 2 * radius + 1 wide
+            goes from empty to filled or the other way round
+        '''
         amount = 1 if positive else -1
-        change = (amount, 0) if vertical else (0, amount)
-        offsets = [x for x in range(-radius, radius+1)]
+        r, c = start
         if vertical:
-            pairs = [(0, i) for i in offsets]
+            lanes = [(r + amount, c + i) for i in range(-radius, radius+1) if c + i >= 0]
         else:
-            pairs = [(i, 0) for i in offsets]
+            lanes = [(r + i, c + amount) for i in range(-radius, radius+1) if r + i >= 0]
 
-        def real_cell_has_value(start, offset):
-            sr, sc = start
-            mr, mc = offset
-            r = sr + mr
-            c = sc + mc
-            return self.table.has_value(r, colval(c))
-
-        r, c = start
-        dr, dc = change
-
-        start_pairs = {}
-        for p in pairs:
-            start_pairs[p] = real_cell_has_value((r + dr, c + dc), p)
-
-        found = False
-        for i in range(max_iter):
-            r += dr
-            c += dc
-            place = (r, c)
-            for offset in pairs:
-                initial_val = start_pairs[offset]
-                new_val = real_cell_has_value(place, offset)
-                if initial_val != new_val:
-                    found = True
-                    break
-            if found:
-                break
-        if found:
-            return (r, c)
-        return None
+        found = [self.table.next_change(lr, lc, vertical, positive) for lr, lc in lanes]
+        found = [f[0] if vertical else f[1] for f in found if f is not None]
+        if not found:
+            return None
+        nearest = min(found) if positive else max(found)
+        if vertical:
+            return (nearest, c)
+        return (r, nearest)
 
     def teleport(self, rchange, cchange):
         ncursor = self.cursor
@@ -540,10 +565,17 @@ class SheetWindow(Window):
         inp = self.get_input()
         if inp == 'w':
             self.try_save_file()
+        if inp == 'scripts':
+            self.set_tmp_message(get_loader().report())
+        if inp == 'cache':
+            self.set_tmp_message(memo.report())
         self.start_command(inp)
 
     def save_file(self):
         fname = self.table.filename()
+        if self.is_loading():
+            self.set_tmp_message('Still loading, not saved: {}'.format(fname))
+            return
         self.table.save()
         try:
             self.set_tmp_message('Saved file: {}'.format(fname))
@@ -559,18 +591,6 @@ class SheetWindow(Window):
         self.add_child(p)
         self.set_active(p)
 
-    def transfer_cell(self, start, dest):
-        sr, sc = start
-        dr, dc = dest
-        form = self.table.get_formula(sr, sc)
-        self.clear_cell_inner(*dest)
-        if form:
-            formula = form.make_child(dest)
-            self.table.add_formula(dr, dc, formula)
-        else:
-            v = self.table.get_cell_value(sc, sr)
-            self.table.set_value(dr, dc, v)
-
     def clear_cell_inner(self, row, col):
         self.table.remove_formula(row, col)
         self.table.set_value(row, col, None)
@@ -585,9 +605,10 @@ class SheetWindow(Window):
             rM = max(rows)
             cm = min(cols)
             cM = max(cols)
-            for r in range(rm, rM+1):
-                for c in range(cm, cM+1):
-                    self.clear_cell_inner(r, colval(c))
+            with self.table.batch():
+                for r in range(rm, rM+1):
+                    for c in range(cm, cM+1):
+                        self.clear_cell_inner(r, colval(c))
             self.end_select()
         else:
             r, c = self.cursor
@@ -601,59 +622,39 @@ class SheetWindow(Window):
         self.grabbing = True
 
     def end_grab(self):
+        with self.table.batch():
+            self.transfer_grabbed_cells()
+        self.grabbing = False
+        self.grab_start = None
+        self.end_select()
+
+    def transfer_grabbed_cells(self):
         (bottom_row, right_col), (top_row, left_col) = normalize_anchor(*self.grab_start)
         cur_row, cur_col = self.cursor
 
         if cur_col > right_col:
-            cols = cur_col - right_col
+            cols = [colval(c) for c in range(right_col + 1, cur_col + 1)]
             for r in range(top_row, bottom_row + 1):
-                for c in range(cols):
-                    src_col = right_col + c
-                    dst_col = src_col + 1
-                    source = (r, colval(src_col))
-                    dest = (r, colval(dst_col))
-                    self.transfer_cell(source, dest)
+                self.table.fill(r, colval(right_col), [r], cols)
             right_col = cur_col
 
         if cur_col < left_col:
-            cols = left_col - cur_col
+            cols = [colval(c) for c in range(cur_col, left_col)]
             for r in range(top_row, bottom_row + 1):
-                for c in range(cols):
-                    src_col = left_col - c
-                    dst_col = src_col - 1
-                    source = (r, colval(src_col))
-                    dest = (r, colval(dst_col))
-                    self.transfer_cell(source, dest)
+                self.table.fill(r, colval(left_col), [r], cols)
             left_col = cur_col
 
         # Modify Cols
 
         if cur_row > bottom_row:
-            rows = cur_row - bottom_row
+            rows = range(bottom_row + 1, cur_row + 1)
             for c in range(left_col, right_col + 1):
-                column = colval(c)
-                for r in range(rows):
-                    src_row = bottom_row + r
-                    dst_row = src_row + 1
-                    source = (src_row, column)
-                    dest = (dst_row, column)
-                    self.transfer_cell(source, dest)
+                self.table.fill(bottom_row, colval(c), rows, [colval(c)])
 
         if cur_row < top_row:
-            rows = bottom_row - cur_row
+            rows = range(cur_row, top_row)
             for c in range(left_col, right_col + 1):
-                column = colval(c)
-                for r in range(rows):
-                    src_row = top_row - r
-                    dst_row = src_row - 1
-                    source = (src_row, column)
-                    dest = (dst_row, column)
-                    self.transfer_cell(source, dest)
-
-        self.grabbing = False
-        self.grab_start = None
-        self.end_select()
-        self.force_refresh()
+                self.table.fill(top_row, colval(c), rows, [colval(c)])
 
     def end_select(self):
         self.select_anchor = None
@@ -703,15 +704,7 @@ class SheetWindow(Window):
 
     def paste(self):
         row, col = self.cursor
-        for r, c in self.yank_vals:
-            dst_row = row + r
-            dst_col = colval(col + c)
-            val = self.yank_vals[(r,c)]
-            if isinstance(val, Formula):
-                child = val.make_child((dst_row, dst_col))
-                self.table.add_formula(dst_row, dst_col, child)
-            else:
-                self.table.set_value(dst_row, dst_col, val)
+        self.table.paste(row, colval(col), self.yank_vals)
 
     def get_motion_size(self, base_val=1):
         if not self.current_motion:
@@ -833,7 +826,10 @@ class SheetWindow(Window):
             if char == ord('<'):
                 self.change_column_size(negative=True)
             if char == ord('R'):
-                self.force_refresh()
+                if self.select_anchor:
+                    self.refresh_selection()
+                else:
+                    self.force_refresh()
 
 
         ## MOVEMENT ##